@@ -1,20 +1,31 @@
 import logging
-from db import Session, Statistics
+from db import Session, SessionConflict, Statistics
+import content
+from router import Router
+from keyboards import KeyboardCache, reply_keyboard, pairs
+from dispatcher import Dispatcher
+from dedup import UpdateDeduplicator
+from webhook import WebhookResource, set_webhook
+from polling import LongPoller
+import outbound
 import telebot
 from telebot import types
 import random
-import pandas as pd
-import numpy as np
 import secrets
-from config import TOKEN, USE_WEBHOOK, URL, ADMINS, ABOUT_TEXT
+from config import TOKEN, USE_WEBHOOK, URL, ADMINS, ABOUT_TEXT, STATS_FLUSH_INTERVAL, STATS_FLUSH_SIZE, CONTENT_WATCH_INTERVAL
+from config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_INLINE_REPLY
+from config import POLLING_WORKERS, POLLING_BATCH_SIZE, POLLING_TIMEOUT
+from config import RUN_MODE, UPDATE_PARTITIONS, UPDATE_STREAM_MAXLEN, UPDATE_MAX_DELIVERIES, WORKER_LEASE_TTL
+from config import STORAGE_BACKEND, UPDATE_DEDUP_TTL, UPDATE_DEDUP_RING
+from config import OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_POOL_SIZE
 
 
 import os
-import json
-import ipaddress
+import functools
+from datetime import datetime, timedelta, timezone
 from twisted.internet import ssl, reactor
-from twisted.web.resource import Resource, ErrorPage
-from twisted.web.server import Site, Request
+from twisted.web.resource import ErrorPage
+from twisted.web.server import Site
 
 WEBHOOK_HOST = URL
 WEBHOOK_PORT = 443 #    #443  # 443, 80, 88 or 8443 (port need to be 'open')
@@ -24,123 +35,85 @@ WEBHOOK_SSL_CERT = 'assets/spmintbot_cert.pem'  # Path to the ssl certificate
 WEBHOOK_SSL_PRIV = 'assets/spmintbot_pkey.pem'  # Path to the ssl private key
 
 WEBHOOK_URL_BASE = "https://{url}".format(url = URL ) 
-WEBHOOK_URL_SALT =  secrets.token_urlsafe(16)
+WEBHOOK_URL_SALT =  os.environ.get('WEBHOOK_URL_SALT') or secrets.token_urlsafe(16)
+#Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token каждого запроса
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN') or secrets.token_urlsafe(32)
 WEBHOOK_URL_PATH = "/{token}/".format( token= TOKEN)
 
 logger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
-bot = telebot.TeleBot(TOKEN)
+#обновления раскладывает по потокам dispatcher (или воркер потоков Redis), собственный пул telebot не нужен
+bot = telebot.TeleBot(TOKEN, threaded = False)
+dispatcher = None
+worker = None
+poller = None
 
-aligned_polls = {} #здесь не более 1 уровня вложенности. Ключ - имя пункта меню, значене - список с именами вложенных меню
-poll_datasets = {} #базы с вопросами/ответами для самоаудита и квиза
-poll_strings = {} #строковые значения для опросников (например, приглашения)
+#все запросы к API идут через общий пул соединений, отправка сообщений - с ограничением скорости
+limiter = outbound.OutboundLimiter(global_rate = OUTBOUND_GLOBAL_RATE, chat_rate = OUTBOUND_CHAT_RATE, chat_burst = OUTBOUND_CHAT_BURST)
+outbound.install(limiter, pool_size = OUTBOUND_POOL_SIZE)
 
+#повторные доставки обновлений отбрасываются до обработчиков; с Redis - общий учёт для всех процессов
+dedup = UpdateDeduplicator(shared = STORAGE_BACKEND == 'redis', ttl = UPDATE_DEDUP_TTL, ring_size = UPDATE_DEDUP_RING)
 
-def read_dataset(filename:str):
-    def remove_mrkdwn_escape(input: str)->str:
-        'уберём "экранирующую" \ перед служебными markdown-символами'
-        
-        i = input.replace('\!','!')
-        i = i.replace('\.','.')
-        i = i.replace('\–','-')
-        i = i.replace('\-','-')
-        i = i.replace('\(','(')
-        i = i.replace('\)',')')
-        i = i.replace('\_','_')
-        i = i.replace('\[','[')
-        i = i.replace('\]',']')
-        i = i.replace('\*','*')
-
-        return i
+quizzes  = ['Квиз-разминка']
 
-    
-    f_type = filename.split('.')[1]
+content.load_content()
 
-    if f_type == 'csv': 
-        data = pd.read_csv(filename, sep=',', names=['key', 'val'])
-    elif f_type == 'xlsx':
-        data = pd.read_excel(filename, names = ['key','val'], header=None, usecols=[0,1])
+#инициализируем статистику
+stats = Statistics(content.current().poll_datasets.keys(), flush_interval = STATS_FLUSH_INTERVAL, flush_size = STATS_FLUSH_SIZE)
+stats.migrate_legacy_counters()
+stats.reconcile_totals(force = False)
 
+#после перезагрузки контента новые опросы сразу регистрируем в статистике
+content.on_reload(lambda snapshot: stats.warm_up(list(snapshot.poll_datasets.keys())))
 
-    #выделим строки, относящиеся к вопросам: question*, answer*, comment*
-    q = (data[data.key.str[:8]=='question']).copy()
-    q = q.append(data[data.key.str[:6]=='answer']   , ignore_index= False)
-    q = q.append(data[data.key.str[:7]=='comment']   , ignore_index= False)
+if CONTENT_WATCH_INTERVAL > 0:
+    content.watch(CONTENT_WATCH_INTERVAL)
 
-    q['level'] =q['key'].astype(str).str.extract(r'(?P<level>\d{1,2})\.?')
-    q['level'] = q['level'].astype(int)
-    
-    q['key'] =  q['key'].astype(str).str.replace(r'(?P<level>\d{1,2})\.', '', regex=True)
-    q['key'] =  q['key'].astype(str).str.replace('question\d{1,2}','question', regex=True)
-    
-    #очистим markdown у вариантов ответов - там такой синтаксис не поддерживается
-    #но сначала сделаем копию markdown-значений, пригодится
-    answers = q[q['key'].str[:6]=='answer'].copy() 
-    answers['key'] = answers['key'].str.replace('answer','mkdwn_answer')
-    q.loc[q['key'].str[:6]=='answer','val'] = q[q['key'].str[:6]=='answer']['val'].apply(lambda x: remove_mrkdwn_escape(x)) 
-    q = q.append(answers, ignore_index=False)
-    
-    #...и у вопросов точно так же
-    questions = q[q['key'].str[:8]=='question'].copy() 
-    questions['key'] = questions['key'].str.replace('question','mkdwn_question')
-    q.loc[q['key']=='question','val'] = q[q['key']=='question']['val'].apply(lambda x: remove_mrkdwn_escape(x)) 
-    q = q.append(questions, ignore_index= False)
+#все текстовые кнопки разбираются одним словарём, а не перебором func= у обработчиков telebot
+router = Router(is_admin = lambda msg: msg.from_user.username in ADMINS)
 
-    q = q.pivot(index='level',columns='key', values ='val')
-    
-    
-    prologue = ''
-    epilogue = ''
-    if len(data[data['key']=='prologue']) >0:
-        prologue = (data[data['key']=='prologue']).iloc[0,1]
-
-    if len(data[data['key']=='epilogue']) >0:
-        epilogue = (data[data['key']=='epilogue']).iloc[0,1]
-
-    return q, prologue, epilogue
-
-
-def read_poll_config(node):
-    for key, val in node.items():
-        if isinstance(val, dict):
-            aligned_polls[key] = val.keys()
-            if '_prompt' in val.keys():
-                poll_strings[key] = {'_prompt': val['_prompt']}
-
-            read_poll_config(val)
-
-        elif isinstance(val, str):
-            if  (val[:6] =='assets'): #это путь к датасету
-                dataset, prologue, epilogue  = read_dataset(val)
-                
-                poll_datasets[key] = dataset
-                
-                if key not in poll_strings.keys():
-                    poll_strings[key] = {}
-                poll_strings[key]['prologue'] = prologue
-                poll_strings[key]['epilogue'] = epilogue 
-            
-            elif key == '_prompt':
-                continue
-            
+#клавиатуры меню собираются и сериализуются один раз на срез контента
+keyboards = KeyboardCache()
 
 
+SESSION_CONFLICT_RETRIES = 3
 
-quizzes  = ['Квиз-разминка']
 
-with open('conf/audit.conf', encoding='utf-8') as f:
-    read_poll_config(json.load(f))
+def in_session_transaction(handler):
+    """
+        обработчик целиком выполняется в одной транзакции сессии пользователя:
+        состояние читается из базы один раз, а все изменения пишутся одним MULTI/EXEC после обработки.
+        Сообщения, которые отправляет обработчик, уходят только после записи (outbound.deferred_calls),
+        поэтому при конфликте обработчик можно просто выполнить заново - пользователь не получит ответ дважды.
+        Если конфликты не кончились, SessionConflict уходит выше: обновление не отмечается обработанным.
+        Вложенные вызовы (например, go_next из handle_poll) работают в той же транзакции
+    """
+
+    @functools.wraps(handler)
+    def wrapper(message, *args, **kwargs):
+        #у коллбэков и сообщений пользователь в from_user, у ответов на опрос - в user
+        user = getattr(message, 'from_user', None) or getattr(message, 'user', None)
+        if user is None:
+            return handler(message, *args, **kwargs)
 
-with open('conf/quizzes.conf', encoding='utf-8') as f:
-    read_poll_config(json.load(f))
+        session = Session.get_by_uid(user.id)
+        if session.in_transaction:
+            return handler(message, *args, **kwargs)
 
-#теперь загрузим дерево ответов для критичных ситуаций
-emergency_dialogue = {}
-with open('conf/emergency.conf',  encoding='utf-8') as f:
-    emergency_dialogue = json.load(f)    
+        for attempt in range(SESSION_CONFLICT_RETRIES + 1):
+            try:
+                with outbound.deferred_calls() as calls, session.transaction():
+                    rez = handler(message, *args, **kwargs)
+                    session.after_commit(calls.flush)
+                return rez
+            except SessionConflict as e:
+                #параллельное обновление того же пользователя уже изменило сессию - наши изменения и сообщения отброшены
+                if attempt == SESSION_CONFLICT_RETRIES:
+                    raise
+                logger.warning('%s, retrying', e)
 
-#инициализируем статистику
-stats = Statistics(poll_datasets.keys())
+    return wrapper
 
 
 
@@ -165,67 +138,42 @@ def show_start_menu(chat_id, username = ''):
     session  = Session.get_by_uid(chat_id)
     session.reset()
     
-    start_menu = types.ReplyKeyboardMarkup(True, True)
-    start_menu.row('Квиз-разминка', 'Критические ситуации')
-    start_menu.row( 'Самоаудит')
-    
-    if username in ADMINS:
-        start_menu.row('Показать статистику') #, 'Сбросить статистику')
+    admin = username in ADMINS
+    start_menu = keyboards.get(content.current(), ('start', admin), lambda: reply_keyboard(
+        [['Квиз-разминка', 'Критические ситуации'], ['Самоаудит']] +
+        ([['Показать статистику']] if admin else []))) #, 'Сбросить статистику'
         
     bot.send_message(chat_id, 'Выбери раздел:', reply_markup=start_menu)
 
-@bot.message_handler(func= lambda msg: msg.text in aligned_polls.keys(), content_types=['text'])
+@router.route_content(lambda snapshot: snapshot.aligned_polls.keys())
+@content.pinned()
 def show_audit_menu(message):
     node = message.text
-    
-    options_kbd = types.ReplyKeyboardMarkup(True, True)
-
-    even = False
-    row = []
-    prompt = 'Варианты: '
-    for i in aligned_polls[node]:
-        if i =='_prompt':
-            #это служебный пункт
-            prompt = poll_strings[node]['_prompt']
-            continue
-
-        row.append(i)
-        if even:
-            options_kbd.row(row[0], row[1])    
-            row = []
-
-        even = not even
-    if len(row):
-        options_kbd.row(row[0])
-    
-    options_kbd.row('В начало')
+    snapshot = content.current()
+
+    #_prompt - служебный пункт, это не кнопка
+    prompt = snapshot.poll_strings.get(node, {}).get('_prompt', 'Варианты: ')
+    options_kbd = keyboards.get(snapshot, ('audit', node), lambda: reply_keyboard(
+        pairs(i for i in snapshot.aligned_polls[node] if i != '_prompt') + [['В начало']]))
+
     bot.send_message(message.chat.id, prompt, reply_markup=options_kbd)
 
-@bot.message_handler(func= lambda msg: msg.text == 'Критические ситуации', content_types=['text'])
+@router.route('Критические ситуации')
+@content.pinned()
 def show_emergency_menu(message):
     #gif = 'https://media.giphy.com/media/Tdpbuz8KP0EpQfJR3T/giphy.gif'
     #bot.send_animation(message.chat.id, gif)
     
-    critical_menu = types.ReplyKeyboardMarkup(True, True)
-    even = False
-    row = []
-    for i in emergency_dialogue.keys():
-        row.append(i)
-        if even:
-            critical_menu.row(row[0], row[1])    
-            row = []
-
-        even = not even
-    if len(row):
-        critical_menu.row(row[0])
-    
-    critical_menu.row('В начало')
+    snapshot = content.current()
+    critical_menu = keyboards.get(snapshot, ('emergency',), lambda: reply_keyboard(
+        pairs(snapshot.emergency_dialogue.keys()) + [['В начало']]))
+
     bot.send_message(message.chat.id, 'Критические Ситуации. Варианты:', reply_markup=critical_menu)
 
-@bot.message_handler(func=lambda msg: msg.text in emergency_dialogue.keys(), 
-    content_types=['text'] )
+@router.route_content(lambda snapshot: snapshot.emergency_dialogue.keys())
+@content.pinned()
 def show_emergency(message):
-    for msg in emergency_dialogue[message.text]:
+    for msg in content.current().emergency_dialogue[message.text]:
         bot.send_message(message.chat.id, msg, disable_web_page_preview=True, parse_mode='MarkdownV2')
 
     show_emergency_menu(message)
@@ -234,62 +182,70 @@ def show_emergency(message):
 
 
 
-@bot.message_handler(func=lambda msg: (msg.text == 'Показать статистику' 
-        and msg.from_user.username in ADMINS), 
-        content_types=['text'] )
+@router.route('Показать статистику', admin = True)
 def show_statistics_menu(message):
     prompt = 'выбери раздел, по которому нужна статистика'
 
-    options_kbd = types.ReplyKeyboardMarkup(True, True)
-    options_kbd.row('Общее число кликов')
-    even = False
-    row = []
-    for poll in stats.saved_polls:
-        row.append('Статистика: {}'.format(poll))
-        if even:
-            options_kbd.row(row[0], row[1])    
-            row = []
-
-        even = not even
-    if len(row):
-        options_kbd.row(row[0])
-    
-    options_kbd.row('В начало')
+    #список опросов входит в ключ: появился новый опрос - клавиатура соберётся заново
+    saved_polls = tuple(stats.saved_polls)
+    options_kbd = keyboards.get(content.current(), ('statistics', saved_polls), lambda: reply_keyboard(
+        [['Общее число кликов'], list(activity_periods.keys())] +
+        pairs('Статистика: {}'.format(poll) for poll in saved_polls) + [['В начало']]))
+
     bot.send_message(message.chat.id, prompt, reply_markup=options_kbd)
 
 
-@bot.message_handler(func=lambda msg: (msg.text == 'Общее число кликов' 
-    and msg.from_user.username in ADMINS), 
-    content_types=['text'] )
+@router.route('Общее число кликов', admin = True)
 def show_all_clicks(message):
     bot.send_message( message.from_user.id, 'Всего было {cnt} кликов'.format(cnt= stats.get_all_answers_count()))
     show_statistics_menu(message) #вернемся к выбору статистики
 
 
-@bot.message_handler(regexp='Статистика:.*', 
-    func= lambda msg: msg.from_user.username in ADMINS , 
-    content_types=['text'])
+#периоды для отчёта об активности: кнопка -> (длина периода, по каким корзинам считать ответы)
+activity_periods = {
+    'Активность: сутки': (timedelta(days = 1), 'hour'),
+    'Активность: неделя': (timedelta(days = 7), 'day'),
+    'Активность: месяц': (timedelta(days = 30), 'day'),
+}
+
+@router.route(*activity_periods.keys(), admin = True)
+def show_activity(message):
+    period, granularity = activity_periods[message.text]
+    since = datetime.now(timezone.utc) - period
+
+    rez = '{title} (UTC)\n\n'.format(title = message.text)
+    for poll in stats.saved_polls:
+        answers = sum(cnt for _, cnt in stats.get_answers_timeline(poll, since, granularity = granularity))
+        users = stats.get_unique_users(poll, since, granularity = granularity)
+        rez = rez + '{poll}\n   ответов: {answers}, пользователей: ~{users}\n'.format(poll = poll, answers = answers, users = users)
+
+    bot.send_message(message.from_user.id, rez)
+    show_statistics_menu(message) #вернемся к выбору статистики
+
+
+@router.route_prefix('Статистика:', admin = True)
+@content.pinned()
 def show_stats_report(message):
 
     poll_name = message.text.split(':')[-1].strip()
 
-    if poll_name not in poll_datasets.keys():
+    if poll_name not in content.current().poll_datasets.keys():
         bot.send_message(message.from_user.id, 'Опрос не обнаружен')
         return
 
-    data = poll_datasets[poll_name]
+    poll = content.current().poll_datasets[poll_name]
     raw_report = stats.get_poll_stat(poll_name)
     
     rez = "Опрос: {poll_name}\n".format(poll_name = poll_name)
-    for i, row in data.iterrows():
-        q_number = 'question{}'.format(i)  
-        rez = rez+ '{q}\n'.format(q= row['question'])
+    for level, question in enumerate(poll):
+        q_number = 'question{}'.format(level)  #в статистике вопросы нумеруются так же, как poll_level в сессии
+        rez = rez+ '{q}\n'.format(q= question.text)
         
         if q_number in raw_report.keys():
             rez = rez+ 'количество ответов:     ответ\n'       
 
             for answer, cnt in raw_report[q_number].items():
-                rez = rez + '   {cnt}:    {a}\n'.format(cnt = cnt, a = row[answer])
+                rez = rez + '   {cnt}:    {a}\n'.format(cnt = cnt, a = question.answer(int(answer[len('answer'):])))
         else:
             rez = rez + 'ответов не было\n'
 
@@ -299,9 +255,62 @@ def show_stats_report(message):
     show_statistics_menu(message) #вернемся к выбору статистики
 
 
-@bot.message_handler(func=lambda msg: (msg.text == 'Сбросить статистику' 
-    and msg.from_user.username in ADMINS), 
-    content_types=['text'] )
+@bot.message_handler(commands=['reload'], 
+    func= lambda msg: msg.from_user.username in ADMINS)
+def reload_content(message):
+    """
+        перечитать изменившиеся конфиги и датасеты без перезапуска бота
+    """
+    try:
+        changed = content.reload()
+    except Exception as e:
+        bot.send_message(message.from_user.id, 'Не получилось обновить контент: {}'.format(e))
+        return
+
+    if changed:
+        bot.send_message(message.from_user.id, 'Обновлено:\n{}'.format('\n'.join(sorted(changed))))
+    else:
+        bot.send_message(message.from_user.id, 'Изменений нет')
+
+
+@bot.message_handler(commands=['metrics'], 
+    func= lambda msg: msg.from_user.username in ADMINS)
+def show_metrics(message):
+    """
+        состояние очередей обработки обновлений и отправки сообщений
+    """
+    if worker is not None:
+        m = worker.metrics
+        backlog = worker._stream.backlog
+        rez = ('Воркер {name}, партиции: {partitions}\n'
+            'обработано: {processed}, повторов: {retried}, в мёртвые письма: {dead}, забрано у других: {claimed}\n'
+            'в потоках: {lengths}, не подтверждено: {pending}, мёртвых писем всего: {total_dead}\n').format(
+                name = worker.name, partitions = ', '.join(str(p) for p in m['partitions']),
+                processed = m['processed'], retried = m['retried'], dead = m['dead'], claimed = m['claimed'],
+                lengths = sum(backlog['lengths']), pending = sum(backlog['pending']), total_dead = backlog['dead'])
+    elif dispatcher is None:
+        rez = 'Очереди обновлений не используются\n'
+    else:
+        m = dispatcher.metrics
+        rez = ('Очереди обновлений\n'
+            'в очереди: {queued} (по потокам: {depths}), максимум: {max_depth}\n'
+            'принято: {accepted}, отклонено (429): {rejected}\n'
+            'обработано: {processed}, с ошибкой: {failed}\n').format(
+                depths = ', '.join(str(d) for d in m['depths']), **{k: v for k, v in m.items() if k != 'depths'})
+        if poller is not None:
+            rez = rez + ('getUpdates: пачек {batches}, обновлений {updates}, в последней пачке {last_batch}, '
+                'ошибок {errors}, offset {offset}\n').format(**poller.metrics)
+
+    rez = rez + ('повторных доставок: {duplicates} из {checked} ({rate}%), ошибок проверки: {errors}\n').format(**dedup.metrics)
+
+    rez = rez + ('\nОтправка сообщений\n'
+        'ждут отправки: {waiting}, отправлено: {sent} (в ответе вебхука: {inline}), с ошибкой: {failed}\n'
+        'ждали лимита: {throttled} раз, всего {waited_seconds} с\n'
+        'получено 429 от Telegram: {rate_limited}, чатов в кэше: {chats}').format(**limiter.metrics)
+    bot.send_message(message.from_user.id, rez)
+
+
+@router.route('Сбросить статистику', admin = True)
 def reset_stats(message):
     bot.send_message(message.from_user.id, 'Сброс статистики отключён')
     
@@ -314,6 +323,8 @@ def reset_stats(message):
 
 
 @bot.callback_query_handler(func= lambda call: call.data == 'next')
+@in_session_transaction
+@content.pinned()
 def go_next(message, this_is_callback=True):
     """
         Выводим очередной вопрос из опроса - и варианты ответа к нему.
@@ -349,39 +360,35 @@ def go_next(message, this_is_callback=True):
 
     this_is_quiz = current_poll in quizzes
 
-    data = poll_datasets[current_poll]
+    poll = content.current().poll_datasets[current_poll]
     level = session.poll_level
 
-    #определим количество колонок с ответами. API позволяет не более 10 вариантов
-    answers = ['answer{0}'.format(i) for i  in range(1,10) if 'answer{0}'.format(i) in data.columns  ]
-    
     #выведем текущий вопрос
-    if level < len(data):
+    if level < len(poll):
     
-        row = data.iloc[level].to_dict()
-        poll_opts = [row[ans][:99] for ans in answers if row[ans] is not np.nan]
-
+        question = poll[level] #варианты ответа уже обрезаны под ограничения API
 
         if this_is_quiz:
+            poll_opts = list(question.options)
             random.shuffle(poll_opts)
             session.poll_options = poll_opts
 
-            bot.send_poll(chat_id=user_id, question=row['question'][:299] ,
+            bot.send_poll(chat_id=user_id, question=question.poll_text ,
                             is_anonymous=False, options=poll_opts, type="quiz",
-                            correct_option_id= poll_opts.index(row['answer1'][:99]))
+                            correct_option_id= poll_opts.index(question.correct_option))
         else:
-            bot.send_poll(chat_id=user_id, question=row['question'][:299] ,
-                            is_anonymous=False, options=poll_opts, type="regular")
+            bot.send_poll(chat_id=user_id, question=question.poll_text ,
+                            is_anonymous=False, options=list(question.options), type="regular")
 
         
     else:
         #результаты
         
-        if len(data) > 0: #если вообще были какие-то вопросы
+        if len(poll) > 0: #если вообще были какие-то вопросы
             score = session.correct_answers_count
-            rez = 'Твой результат: {0} из {1} \n\n'.format(score, len(data))
+            rez = 'Твой результат: {0} из {1} \n\n'.format(score, len(poll))
             if this_is_quiz:
-                if score > len(data)*0.7:
+                if score > len(poll)*0.7:
                     rez = rez + 'Отличный результат\! А материалы бота помгут ещё сильнее улучшить его\.\n\nЕсли хочешь узнать больше про то, как можно улучшить цифровую безопасность твоих устройств — переходи в Самоаудит\!'
                 else:
                     rez = rez + 'Есть куда стремиться\. А материалы бота помогут быстрее улучшить твои навыки\.\n\nЕсли хочешь узнать больше про то, как можно улучшить цифровую безопасность твоих устройств — переходи в Самоаудит\!'
@@ -389,32 +396,13 @@ def go_next(message, this_is_callback=True):
                 bot.send_message(chat_id = user_id, text = rez, parse_mode='MarkdownV2')
             
             else:
-                delimiter = ' \n '
-                
-                poll_answers = session.poll_answers
-                for a in poll_answers:
-                    row = data.iloc[a['level']].to_dict() 
-
-                    raw_comment = row['comment{0}'.format(a['answer'])]
-                    comment = raw_comment if raw_comment is not np.nan else 'отлично\!'
-
-                    curr_line = '🌿: {q} \n*__Твой ответ__*: {a} \n*__Наш комментарий__*: {recipe} {delimiter}'.format(q= row['mkdwn_question'],
-                        a = row['mkdwn_answer{0}'.format(a['answer'])],
-                        recipe = comment,
-                        delimiter = delimiter)
-                    rez = rez + '\n' + curr_line
-                
-                part = rez
-                while len(rez.strip())> 0:
-                    part = rez[:4000]
-                    pos = part.rfind(delimiter)
-                    part = rez[:pos]
-                    rez = rez[(pos+5):]#перенос строки не учитываем
-                    bot.send_message(chat_id = user_id, text = part, parse_mode='MarkdownV2', disable_web_page_preview=True) 
-
-                #bot.send_message(chat_id = user_id, text = rez)
-
-        epilogue = poll_strings[current_poll]['epilogue']
+                #фрагменты отчёта собраны при загрузке контента, здесь они только нарезаются на сообщения
+                lines = (poll[a['level']].report_line(a['answer']) for a in session.poll_answers)
+                for part in content.chunk_messages((line for line in lines if line is not None),
+                        separator = content.REPORT_SEPARATOR, head = rez + '\n'):
+                    bot.send_message(chat_id = user_id, text = part, parse_mode='MarkdownV2', disable_web_page_preview=True)
+
+        epilogue = content.current().poll_strings[current_poll]['epilogue']
         if epilogue !='':
             bot.send_message(user_id, epilogue, disable_web_page_preview=True, parse_mode='MarkdownV2')    
             
@@ -424,7 +412,9 @@ def go_next(message, this_is_callback=True):
         show_start_menu(user_id, user_name )
 
 
-@bot.message_handler(func= lambda msg: msg.text in poll_datasets.keys() )
+@router.route_content(lambda snapshot: snapshot.poll_datasets.keys())
+@in_session_transaction
+@content.pinned()
 def start_poll(message):
     """
         запустим опрос или квиз
@@ -438,9 +428,9 @@ def start_poll(message):
     session.current_poll = current_poll
 
     #проверим, есть ли у нас вообще вопросы по этой теме
-    questions_n = len(poll_datasets[current_poll])
+    questions_n = len(content.current().poll_datasets[current_poll])
 
-    prologue = poll_strings[current_poll]['prologue']
+    prologue = content.current().poll_strings[current_poll]['prologue']
 
     if len(prologue):
         bot.send_message(chat_id = message.chat.id, text = prologue, parse_mode='MarkdownV2')
@@ -456,6 +446,8 @@ def start_poll(message):
 
     
 @bot.poll_answer_handler(func=lambda message: True)
+@in_session_transaction
+@content.pinned()
 def handle_poll(message):
     """
         Обрабатываем ответ на вопрос, учитываем набранные очки
@@ -474,17 +466,12 @@ def handle_poll(message):
 
     this_is_quiz = current_poll in quizzes
 
-    data = poll_datasets[current_poll]
     level = session.poll_level
+    question = content.current().poll_datasets[current_poll][level] #получим все свойства вопроса
 
-    #определим количество колонок с ответами. API позволяет не больше 10 ответов
-    answers = ['answer{0}'.format(i) for i  in range(1,10) if 'answer{0}'.format(i) in data.columns  ]
-    
     #выведем комментарий к выбранному ответу
     #для этого для начала найдём номер выбранного ответа, чтобы по нему найти комментарий
     
-    row  = data.iloc[level].to_dict() #получим все свойства вопроса
-    
     if this_is_quiz:
         #тут немного неочевидно. В option_ids - номер выбранного ответа
         #но в квизе ответы тасуются перед выдачей. то есть только в момент выдачи квиза мы знаем соответствие номера и ответа
@@ -492,9 +479,7 @@ def handle_poll(message):
         poll = session.poll_options
         answer = poll[option_ids[0]] #текст выбранного ответа
 
-        prev_data = [(row[answ])[:99] for answ in answers if row[answ] is not np.nan ] #опции для выбора ответа
-        
-        pos  = prev_data.index(answer) +1 #индекс начинается с 0, а названия колонок - с 1
+        pos  = question.options.index(answer) +1 #индекс начинается с 0, а названия колонок - с 1
     else:
         #в опросниках всё просто: номер ответа - это номер из конфига
         pos = option_ids[0] +1 #индекс начинается с 0, а названия колонок - с 1
@@ -502,13 +487,14 @@ def handle_poll(message):
     #запомним данный ответ для формирования итогового отчёта
     session.memorize_answer({'level': level, 'answer': pos})
 
-    stats.reckon_answer(current_poll, level, pos) #отметим в статистике номер выданного ответа  
+    #отметим в статистике номер выданного ответа - только если ответ записался в сессию
+    session.after_commit(lambda: stats.reckon_answer(current_poll, level, pos, user = Session.salt_uid(user_id)))
 
     #передвинем на следующий уровень чтобы выдать следующий вопрос
     session.poll_level = level +1
 
-    comment = row['comment{0}'.format(pos)]
-    if comment is np.NaN:
+    comment = question.comment(pos)
+    if comment is None:
         #сразу выведем следующую часть опроса
         go_next(message, this_is_callback=False)
 
@@ -525,19 +511,28 @@ def handle_poll(message):
 
 
     
+@router.route('В начало')
+def go_home(message):
+    show_start_menu(message.from_user.id, message.from_user.username)
+
+
+@router.otherwise
+def handle_unknown(message):
+    """
+        заглушка для всех текстов, которых нет в таблице маршрутов (и для админских кнопок у обычных пользователей)
+    """
+    #универсальная отбивка на неизвестную команду
+    bot.send_message(message.from_user.id, 'что-то пошло не так: неизвестная команда\n Начнём с начала?')
+    show_start_menu(message.from_user.id, message.from_user.username)
+
+
 @bot.message_handler(content_types=['text'])
 def handle_text(message):
     """
-        заглушка для всех команд, которые до этого не были обработаны.
-        в какой-то момент тут не должно не остаться ничего - каждая команда должна обрабатываться своим обрабочиком
+        все текстовые сообщения, кроме команд: обработчик ищется в таблице маршрутов текущего среза контента
     """
-    
-    if message.text == 'В начало':
-        show_start_menu(message.from_user.id, message.from_user.username)
-    else:
-        #универсальная отбивка на неизвестную команду
-        bot.send_message(message.from_user.id, 'что-то пошло не так: неизвестная команда\n Начнём с начала?')
-        show_start_menu(message.from_user.id, message.from_user.username)
+    with content.pinned() as snapshot:
+        router.dispatch(message, snapshot)
 
 
 
@@ -545,47 +540,57 @@ def handle_text(message):
 
 
 
-if __name__ == '__main__':
-    # Remove webhook, it fails sometimes the set if there is a previous webhook
-    bot.delete_webhook()
+def process_update(update, reply = None):
+    """
+        обработка одного обновления. reply - открытый ответ вебхука, в который можно отдать первый вызов API.
+        Уже обработанное обновление (повторная доставка) отбрасывается, если обработка упала - повтор будет принят
+    """
+    with outbound.inline_reply(reply):
+        if dedup.seen(update.update_id):
+            logger.info('duplicate update %s dropped', update.update_id)
+            return
+        bot.process_new_updates([update])
+        dedup.remember(update.update_id)
+
+
+if __name__ == '__main__' and RUN_MODE == 'worker':
+    #воркер не трогает вебхук: им управляют ingress-процессы
+    from streams import UpdateStream, StreamWorker
+    worker = StreamWorker(UpdateStream(partitions = UPDATE_PARTITIONS, maxlen = UPDATE_STREAM_MAXLEN),
+        lambda body: process_update(telebot.types.Update.de_json(body)),
+        lease_ttl = WORKER_LEASE_TTL, max_deliveries = UPDATE_MAX_DELIVERIES)
+    try:
+        worker.run()
+    finally:
+        worker.close()
+
+elif __name__ == '__main__':
+    if RUN_MODE == 'single':
+        # Remove webhook, it fails sometimes the set if there is a previous webhook
+        #(ingress-процессов может быть несколько, каждый просто ставит тот же вебхук заново)
+        bot.delete_webhook()
     if USE_WEBHOOK:
+        if RUN_MODE == 'ingress':
+            #обновления обрабатывают воркеры, здесь их только складываем в потоки Redis
+            from streams import UpdateStream
+            submit = UpdateStream(partitions = UPDATE_PARTITIONS, maxlen = UPDATE_STREAM_MAXLEN).publish
+            inline = False #ответить в HTTP-ответе может только тот, кто обрабатывает обновление
+        else:
+            #обновления одного пользователя обрабатываются по порядку, очереди ограничены
+            dispatcher = Dispatcher(process_update, lanes = WEBHOOK_WORKERS, queue_size = WEBHOOK_QUEUE_SIZE)
+            submit = dispatcher.submit
+            inline = WEBHOOK_INLINE_REPLY
     
         # Set webhook
         # тут вторым параметром должен передаваться SSL-сертификат,
         # но при деплое в Heroku указывать его не надо
 
         path = WEBHOOK_URL_SALT  + TOKEN # 
-        bot.set_webhook(url=WEBHOOK_URL_BASE + '/'+path + '/' ) #, certificate=open(WEBHOOK_SSL_CERT, 'r')
-
-        # Process webhook calls
-        class WebhookHandler(Resource):
-            isLeaf = True
-            def render_POST(self, request: Request):
-                #проверим, с какого IP пришел запрос - и принадлежит ли он телеграму
-
-                #Heroku всегда добавляет в заголовок x-forwarded-for последним тот IP, с которого получил запрос
-                tg_address  = ipaddress.IPv4Address(request.requestHeaders.getRawHeaders('x-forwarded-for')[-1] )         
-                white_subnets = [] #официальные адреса из пула ТГ
-                white_subnets.append(ipaddress.IPv4Network('149.154.160.0/20'))
-                white_subnets.append(ipaddress.IPv4Network('91.108.4.0/22'))
-                
-                
-                address_correct = False
-                for subnet in white_subnets:
-                    address_correct = address_correct or (tg_address in subnet) 
-
-                if not address_correct: #кто-то прикидывается сервером ТГ, но заходит с неправильного IP
-                    print('wrong ip! {}'.format(tg_address) )
-                    return b''
-
-
-                request_body_dict = json.load(request.content)
-                update = telebot.types.Update.de_json(request_body_dict)
-                reactor.callInThread(lambda: bot.process_new_updates([update]))
-                return b''
+        #, certificate=open(WEBHOOK_SSL_CERT, 'r')
+        set_webhook(TOKEN, url = WEBHOOK_URL_BASE + '/'+path + '/', secret_token = WEBHOOK_SECRET_TOKEN)
 
         root = ErrorPage(403, 'Forbidden', '')
-        root.putChild(path.encode(),  WebhookHandler())
+        root.putChild(path.encode(),  WebhookResource(submit, WEBHOOK_SECRET_TOKEN, inline = inline))
         site = Site(root)
         
         #heroku сам управляет сертификатами, поэтому используем  listenTCP вместо listenSSL
@@ -596,4 +601,12 @@ if __name__ == '__main__':
         reactor.run()
      
     else:
-        bot.infinity_polling()
\ No newline at end of file
+        #пачки getUpdates обрабатываются параллельно по пользователям, offset подтверждается после обработки пачки
+        dispatcher = Dispatcher(process_update, lanes = POLLING_WORKERS, queue_size = POLLING_BATCH_SIZE, name = 'polling')
+        poller = LongPoller(bot.get_updates, dispatcher, batch_size = POLLING_BATCH_SIZE, timeout = POLLING_TIMEOUT)
+        try:
+            poller.run()
+        finally:
+            poller.stop()
+            dispatcher.close()
+            poller.commit()
\ No newline at end of file
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+    """
+        Потокобезопасный кэш в памяти с ограничением по размеру и по времени простоя записи.
+
+        Записи хранятся в порядке последнего обращения, поэтому самые давние (и первые кандидаты на вытеснение)
+        всегда лежат в начале словаря: и вытеснение по размеру, и вытеснение протухших записей стоят O(1) на запись
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 86400):
+        """
+            maxsize - максимальное число записей
+            ttl - сколько секунд запись может пролежать без обращений
+        """
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict() # ключ -> (время последнего обращения, значение)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _purge(self, now: float):
+        #протухшие записи всегда в начале - удаляем, пока не встретим живую
+        while self._data:
+            key, (touched, _) = next(iter(self._data.items()))
+            if now - touched < self._ttl:
+                break
+            del self._data[key]
+            self.evictions += 1
+
+    def get_or_create(self, key, factory):
+        """
+            возвращает значение из кэша, а если его нет - создаёт через factory() и запоминает
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+
+            if key in self._data:
+                self.hits += 1
+                value = self._data[key][1]
+                self._data.move_to_end(key)
+            else:
+                self.misses += 1
+                value = factory()
+                if len(self._data) >= self._maxsize:
+                    self._data.popitem(last = False)
+                    self.evictions += 1
+
+            self._data[key] = (now, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self) -> dict:
+        """
+            счётчики для подбора размера кэша
+        """
+        return {
+            'size': len(self._data),
+            'maxsize': self._maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SnapshotMemo():
+    """
+        значение, вычисляемое один раз на срез контента: build(snapshot) вызывается заново,
+        только когда приходит другой срез (то есть после перезагрузки контента)
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._lock = threading.Lock()
+        self._built = (None, None) #(срез, значение для него) - меняются вместе одним присваиванием
+
+    def get(self, snapshot):
+        built = self._built
+        if built[0] is not snapshot:
+            with self._lock:
+                built = self._built
+                if built[0] is not snapshot:
+                    built = (snapshot, self._build(snapshot))
+                    self._built = built
+        return built[1]
+
+    def clear(self):
+        self._built = (None, None)
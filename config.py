@@ -1,3 +1,5 @@
+import os
+
 TOKEN= "<TG token>"
 USE_WEBHOOK =    True # False #
 URL = 'host'
@@ -6,6 +8,55 @@ ADMINS = ('<some tg names>') #
 
 UID_SALT = '<sea salt>'
 
+SESSIONS_CACHE_SIZE = 10000 #сколько сессий держать в памяти процесса
+
+#где хранить сессии и статистику: 'redis' - Redis по REDIS_URL, 'memory' - в памяти процесса (для одного инстанса и тестов)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'redis')
+REDIS_URL = os.environ.get('REDIS_URL')
+
+#статистика ответов: 0 - каждый ответ сразу пишется в базу,
+#иначе ответы копятся в памяти и пишутся пачкой раз в STATS_FLUSH_INTERVAL секунд или по STATS_FLUSH_SIZE штук
+STATS_FLUSH_INTERVAL = float(os.environ.get('STATS_FLUSH_INTERVAL', 0))
+STATS_FLUSH_SIZE = 500
+
+#раз в сколько секунд проверять, не изменились ли файлы в conf/ и assets/ (0 - не следить, только команда /reload)
+CONTENT_WATCH_INTERVAL = float(os.environ.get('CONTENT_WATCH_INTERVAL', 0))
+
+#вебхук: обновления обрабатываются в WEBHOOK_WORKERS потоках, обновления одного пользователя - всегда в одном потоке по порядку.
+#У каждого потока очередь не длиннее WEBHOOK_QUEUE_SIZE; если она полна, Telegram получает 429 и повторит доставку позже
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+
+#без вебхука: getUpdates забирает до POLLING_BATCH_SIZE обновлений (не больше 100), ожидая новых до POLLING_TIMEOUT секунд,
+#пачка обрабатывается в POLLING_WORKERS потоках так же, как обновления вебхука, и подтверждается после обработки целиком
+POLLING_WORKERS = int(os.environ.get('POLLING_WORKERS', 4))
+POLLING_BATCH_SIZE = int(os.environ.get('POLLING_BATCH_SIZE', 100))
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 20))
+
+#режим запуска: 'single' - один процесс принимает и обрабатывает обновления,
+#'ingress' - только принимает вебхуки и складывает обновления в Redis Streams, 'worker' - только обрабатывает их оттуда.
+#В разделённом режиме у всех ingress должны быть одинаковые WEBHOOK_URL_SALT и WEBHOOK_SECRET_TOKEN (из окружения)
+RUN_MODE = os.environ.get('RUN_MODE', 'single')
+UPDATE_PARTITIONS = 16 #на сколько потоков Redis делятся обновления; больше воркеров, чем партиций, не нужно
+UPDATE_STREAM_MAXLEN = 100000
+UPDATE_MAX_DELIVERIES = 5 #после стольких неудачных попыток обновление уходит в мёртвые письма
+WORKER_LEASE_TTL = 30
+
+#повторные доставки одного обновления отбрасываются: обработанные update_id помнятся UPDATE_DEDUP_TTL секунд в Redis
+#(с хранилищем в памяти - последние UPDATE_DEDUP_RING штук в памяти процесса)
+UPDATE_DEDUP_TTL = 3600
+UPDATE_DEDUP_RING = 10000
+
+#отвечать на обновление первым вызовом API прямо в HTTP-ответе вебхука (экономит запрос к API на каждое нажатие кнопки)
+WEBHOOK_INLINE_REPLY = os.environ.get('WEBHOOK_INLINE_REPLY', '0') == '1'
+
+#исходящие сообщения: не больше OUTBOUND_GLOBAL_RATE в секунду всего и OUTBOUND_CHAT_RATE в секунду в один чат
+#(с запасом на всплеск до OUTBOUND_CHAT_BURST сообщений), соединения с API держатся в пуле на OUTBOUND_POOL_SIZE штук
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_POOL_SIZE = 16
+
 #text, formatted as Markdown2
 ABOUT_TEXT = '''«Сибирская мята» — это бережный чат\-бот для помощи ЛГБТКИА\+ персонам в области цифровой безопасности\. 
 
@@ -0,0 +1,655 @@
+"""
+    Содержимое бота: меню самоаудита и квизов, датасеты с вопросами и ответами, сценарии для критических ситуаций.
+
+    Всё читается из conf/ и assets/ в неизменяемый срез ContentSnapshot. Обработчики берут текущий срез через current().
+    reload() собирает новый срез (заново разбираются только изменившиеся файлы) и подменяет текущий одним присваиванием,
+    поэтому обработчик, закрепивший срез через pinned(), до конца обновления видит согласованное содержимое.
+
+    Разбор CSV/XLSX через pandas (и openpyxl) медленный, поэтому скомпилированные датасеты хранятся в кэше
+    CONTENT_CACHE вместе с хэшами исходных файлов. При старте pandas нужен только для файлов, которые изменились
+    с момента сборки кэша. Собрать кэш заранее (например, на этапе сборки деплоя): python manage.py build-content-cache
+
+    При сборке среза все тексты, которые отправляются в MarkdownV2, проверяются (check_markdown) вместе с ограничениями
+    Telegram на длину. Ошибочный текст заменяется экранированным без разметки, а ошибка попадает в snapshot.problems,
+    так что во время работы бот отправляет готовые строки и не получает от Telegram ошибок разбора.
+    Список ошибок: python manage.py lint-content
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_CACHE = 'assets/content.cache.json'
+CONTENT_CACHE_VERSION = 1
+
+POLL_CONFIGS = ['conf/audit.conf', 'conf/quizzes.conf']
+EMERGENCY_CONFIG = 'conf/emergency.conf'
+
+logger = logging.getLogger(__name__)
+
+
+#ограничения Telegram API для опросов и сообщений
+POLL_QUESTION_LIMIT = 299
+POLL_OPTION_LIMIT = 99
+POLL_MAX_ANSWERS = 9
+MESSAGE_LIMIT = 4096
+
+#итоговый отчёт самоаудита: по фрагменту на каждый ответ, фрагменты разделены REPORT_SEPARATOR
+REPORT_LINE = '🌿: {q} \n*__Твой ответ__*: {a} \n*__Наш комментарий__*: {comment} '
+REPORT_SEPARATOR = ' \n \n'
+REPORT_NO_COMMENT = 'отлично\\!'
+
+#символы, которые в MarkdownV2 вне сущностей обязательно экранируются
+MARKDOWN_RESERVED = '_*[]()~`>#+-=|{}.!'
+
+_MARKDOWN_UNESCAPE = re.compile(r'\\([!.\-–()_\[\]*])')
+_MARKDOWN_UNESCAPE_ALL = re.compile(r'\\(.)', re.DOTALL)
+_MARKDOWN_ESCAPE = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\])')
+
+
+def remove_mrkdwn_escape(text: str) -> str:
+    'уберём "экранирующую" \ перед служебными markdown-символами - за один проход по строке'
+    return _MARKDOWN_UNESCAPE.sub(lambda m: '-' if m.group(1) == '–' else m.group(1), text)
+
+
+def escape_markdown(text: str) -> str:
+    'экранирует всё, что MarkdownV2 считает разметкой: результат выводится как обычный текст'
+    return _MARKDOWN_ESCAPE.sub(r'\\\1', text)
+
+
+def _find_closing(text: str, token: str, start: int) -> int:
+    'позиция неэкранированного token начиная со start, -1 если его нет'
+    i = start
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+        elif text.startswith(token, i):
+            return i
+        else:
+            i += 1
+    return -1
+
+
+def check_markdown(text: str):
+    """
+        проверяет, что Telegram разберёт text в режиме MarkdownV2: служебные символы экранированы,
+        сущности (*жирный*, _курсив_, __подчёркнутый__, ~зачёркнутый~, ||спойлер||, `код`, [ссылка](url))
+        закрыты и не пересекаются. Возвращает описание первой ошибки или None
+    """
+    entities = [] #открытые сущности, последняя - самая вложенная
+    i = 0
+    while i < len(text):
+        ch = text[i]
+
+        if ch == '\\':
+            if i + 1 == len(text):
+                return 'позиция {}: \\ в конце текста'.format(i)
+            i += 2
+            continue
+
+        if ch == '`':
+            token = '```' if text.startswith('```', i) else '`'
+            end = _find_closing(text, token, i + len(token))
+            if end < 0:
+                return 'позиция {}: не закрыт {}'.format(i, token)
+            i = end + len(token)
+            continue
+
+        if ch == '[':
+            entities.append('[')
+            i += 1
+            continue
+
+        if ch == ']':
+            if not entities or entities[-1] != '[':
+                return 'позиция {}: ] без пары, нужно \\]'.format(i)
+            entities.pop()
+            if not text.startswith('(', i + 1):
+                return 'позиция {}: после [текста] нет (ссылки), нужно \\[ и \\]'.format(i)
+            end = _find_closing(text, ')', i + 2)
+            if end < 0:
+                return 'позиция {}: не закрыта ссылка'.format(i)
+            i = end + 1
+            continue
+
+        if ch in '*_~|':
+            token = ch * 2 if ch in '_|' and text.startswith(ch * 2, i) else ch
+            if token == '|':
+                return 'позиция {}: символ | не экранирован'.format(i)
+            if token in entities:
+                if entities[-1] != token:
+                    return 'позиция {}: {} закрывается внутри {}'.format(i, token, entities[-1])
+                entities.pop()
+            else:
+                entities.append(token)
+            i += len(token)
+            continue
+
+        if ch in MARKDOWN_RESERVED and not (ch == '>' and (i == 0 or text[i - 1] == '\n')):
+            return 'позиция {}: символ {} не экранирован'.format(i, ch)
+        i += 1
+
+    if entities:
+        return 'не закрыт {}'.format(entities[-1])
+    return None
+
+
+def markdown_payload(text: str, source: str, row: str, problems: list, limit: int = MESSAGE_LIMIT) -> str:
+    """
+        готовый к отправке текст в MarkdownV2. Если text не проходит проверку или длиннее limit, ошибка
+        записывается в problems, а вместо text возвращается он же без разметки, полностью экранированный
+        (и обрезанный) - такой текст Telegram гарантированно примет
+    """
+    plain = _MARKDOWN_UNESCAPE_ALL.sub(r'\1', text)
+    error = check_markdown(text)
+    if error is None and utf16_len(plain) > limit:
+        error = 'длина {} больше {}'.format(utf16_len(plain), limit)
+    if error is None:
+        return text
+
+    problems.append((source, row, error))
+    #обрезаем по единицам UTF-16, не разрывая суррогатную пару
+    return escape_markdown(plain.encode('utf-16-le')[:2 * limit].decode('utf-16-le', 'ignore'))
+
+
+def utf16_len(text: str) -> int:
+    'длина в единицах UTF-16 - так Telegram считает длину сообщения'
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _split_long(text: str, limit: int):
+    """
+        режет фрагмент, который не помещается в одно сообщение. Разметку внутри куска сохранить нельзя,
+        поэтому фрагмент выводится как обычный текст, экранированный для MarkdownV2.
+        Пробелы по краям кусков отбрасываются: сообщение из одних пробелов Telegram не примет
+    """
+    text = escape_markdown(_MARKDOWN_UNESCAPE_ALL.sub(r'\1', text))
+    cuts = []
+    size, i = 0, 0
+    while i < len(text):
+        #экранирующий \ не отрываем от символа, который он экранирует
+        step = 2 if text[i] == '\\' else 1
+        width = utf16_len(text[i:i + step])
+        if size + width > limit:
+            cuts.append(i)
+            size = 0
+        size += width
+        i += step
+
+    for start, end in zip([0] + cuts, cuts + [len(text)]):
+        piece = text[start:end].strip()
+        if piece:
+            yield piece
+
+
+def chunk_messages(fragments, separator: str, head: str = '', limit: int = MESSAGE_LIMIT):
+    """
+        собирает готовые фрагменты MarkdownV2 в сообщения не длиннее limit и отдаёт каждое, как только оно собрано.
+        Сообщения режутся только между фрагментами, поэтому разметка не ломается. Каждый фрагмент проходит
+        ровно один раз, так что время линейно от длины отчёта. head - начало первого сообщения (без separator после него)
+    """
+    parts, size = [], 0
+    if head:
+        if utf16_len(head) > limit:
+            yield from _split_long(head, limit)
+        else:
+            parts, size = [head], utf16_len(head)
+    glue = '' #сразу после head разделитель не ставится
+
+    for fragment in fragments:
+        if not parts:
+            glue = ''
+        width = utf16_len(glue) + utf16_len(fragment)
+        if parts and size + width > limit:
+            yield ''.join(parts)
+            parts, size, glue = [], 0, ''
+            width = utf16_len(fragment)
+
+        if width > limit:
+            yield from _split_long(fragment, limit)
+            continue
+
+        parts.append(glue)
+        parts.append(fragment)
+        size += width
+        glue = separator
+
+    if parts:
+        yield ''.join(parts)
+
+
+def read_dataset(filename:str):
+    import pandas as pd #тяжёлый импорт - только если датасет действительно приходится разбирать
+
+    f_type = filename.split('.')[1]
+
+    if f_type == 'csv': 
+        data = pd.read_csv(filename, sep=',', names=['key', 'val'])
+    elif f_type == 'xlsx':
+        data = pd.read_excel(filename, names = ['key','val'], header=None, usecols=[0,1])
+
+
+    #выделим строки, относящиеся к вопросам: question*, answer*, comment*
+    q = (data[data.key.str[:8]=='question']).copy()
+    q = q.append(data[data.key.str[:6]=='answer']   , ignore_index= False)
+    q = q.append(data[data.key.str[:7]=='comment']   , ignore_index= False)
+
+    q['level'] =q['key'].astype(str).str.extract(r'(?P<level>\d{1,2})\.?')
+    q['level'] = q['level'].astype(int)
+    
+    q['key'] =  q['key'].astype(str).str.replace(r'(?P<level>\d{1,2})\.', '', regex=True)
+    q['key'] =  q['key'].astype(str).str.replace('question\d{1,2}','question', regex=True)
+    
+    #очистим markdown у вариантов ответов - там такой синтаксис не поддерживается
+    #но сначала сделаем копию markdown-значений, пригодится
+    answers = q[q['key'].str[:6]=='answer'].copy() 
+    answers['key'] = answers['key'].str.replace('answer','mkdwn_answer')
+    q.loc[q['key'].str[:6]=='answer','val'] = q[q['key'].str[:6]=='answer']['val'].apply(lambda x: remove_mrkdwn_escape(x)) 
+    q = q.append(answers, ignore_index=False)
+    
+    #...и у вопросов точно так же
+    questions = q[q['key'].str[:8]=='question'].copy() 
+    questions['key'] = questions['key'].str.replace('question','mkdwn_question')
+    q.loc[q['key']=='question','val'] = q[q['key']=='question']['val'].apply(lambda x: remove_mrkdwn_escape(x)) 
+    q = q.append(questions, ignore_index= False)
+
+    q = q.pivot(index='level',columns='key', values ='val')
+    
+    
+    prologue = ''
+    epilogue = ''
+    if len(data[data['key']=='prologue']) >0:
+        prologue = (data[data['key']=='prologue']).iloc[0,1]
+
+    if len(data[data['key']=='epilogue']) >0:
+        epilogue = (data[data['key']=='epilogue']).iloc[0,1]
+
+    return q, prologue, epilogue
+
+
+class Question():
+    """
+        один вопрос опроса, скомпилированный из строки датасета: всё, что нужно для выдачи вопроса и разбора ответа,
+        посчитано заранее. Номера ответов (pos) - как в колонках датасета, начиная с 1
+    """
+
+    __slots__ = ('text', 'poll_text', 'mkdwn_text', 'options', 'answers', 'mkdwn_answers', 'comments', 'report_lines')
+
+    def __init__(self, text: str, mkdwn_text: str, answers: tuple, mkdwn_answers: tuple, comments: tuple):
+        self.text = text                              # полный текст вопроса без markdown
+        self.poll_text = text[:POLL_QUESTION_LIMIT]   # текст вопроса для send_poll, уже обрезан
+        self.mkdwn_text = mkdwn_text                  # текст вопроса в MarkdownV2 - для итогового отчёта
+        self.answers = answers                        # полные тексты ответов без markdown, None - ответа нет
+        self.mkdwn_answers = mkdwn_answers            # тексты ответов в MarkdownV2
+        self.comments = comments                      # комментарии к ответам, None - комментария нет
+        # варианты для send_poll, уже обрезанные. Индекс варианта + 1 = номер ответа
+        self.options = tuple(a[:POLL_OPTION_LIMIT] for a in answers if a is not None)
+        # фрагменты итогового отчёта самоаудита для каждого ответа, None - ответа нет
+        self.report_lines = tuple(None if a is None else REPORT_LINE.format(q = mkdwn_text, a = mkdwn_a,
+                comment = comment if comment is not None else REPORT_NO_COMMENT)
+            for a, mkdwn_a, comment in zip(answers, mkdwn_answers, comments))
+
+    def answer(self, pos: int):
+        return self.answers[pos - 1] if 0 < pos <= len(self.answers) else None
+
+    def mkdwn_answer(self, pos: int):
+        return self.mkdwn_answers[pos - 1] if 0 < pos <= len(self.mkdwn_answers) else None
+
+    def comment(self, pos: int):
+        return self.comments[pos - 1] if 0 < pos <= len(self.comments) else None
+
+    def report_line(self, pos: int):
+        return self.report_lines[pos - 1] if 0 < pos <= len(self.report_lines) else None
+
+    @property
+    def correct_option(self) -> str:
+        """
+            в квизах правильный ответ - всегда первый в датасете
+        """
+        return self.options[0]
+
+
+class Poll():
+    """
+        опрос или квиз: неизменяемый кортеж вопросов. Вопрос выдаётся простым индексом poll[level]
+    """
+
+    __slots__ = ('name', 'questions')
+
+    def __init__(self, name: str, questions: tuple):
+        self.name = name
+        self.questions = questions
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __getitem__(self, level: int) -> Question:
+        return self.questions[level]
+
+    def __iter__(self):
+        return iter(self.questions)
+
+
+def compile_poll(name: str, data) -> Poll:
+    """
+        превращает датасет из read_dataset в Poll. pandas нужен только здесь, при загрузке
+    """
+    def text(row: dict, column: str):
+        val = row.get(column)
+        return val if isinstance(val, str) else None
+
+    questions = []
+    for _, row in data.iterrows():
+        row = row.to_dict()
+        numbers = range(1, POLL_MAX_ANSWERS + 1)
+        questions.append(Question(
+            text = text(row, 'question') or '',
+            mkdwn_text = text(row, 'mkdwn_question') or '',
+            answers = tuple(text(row, 'answer{}'.format(n)) for n in numbers),
+            mkdwn_answers = tuple(text(row, 'mkdwn_answer{}'.format(n)) for n in numbers),
+            comments = tuple(text(row, 'comment{}'.format(n)) for n in numbers),
+        ))
+
+    return Poll(name, tuple(questions))
+
+
+def file_hash(filename: str) -> str:
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_content_cache(path: str = CONTENT_CACHE) -> dict:
+    """
+        путь к датасету -> скомпилированная запись. Если кэша нет или он старого формата - пустой словарь
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if cache.get('version') != CONTENT_CACHE_VERSION:
+        return {}
+    return cache['datasets']
+
+
+def write_content_cache(datasets: dict, path: str = CONTENT_CACHE):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'version': CONTENT_CACHE_VERSION, 'datasets': datasets}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp, path) #чтобы параллельный запуск не прочитал недописанный файл
+
+
+def compile_dataset(filename: str) -> dict:
+    """
+        разбирает датасет через pandas и возвращает запись для кэша: хэш файла, пролог, эпилог и вопросы
+    """
+    dataset, prologue, epilogue = read_dataset(filename)
+    poll = compile_poll(filename, dataset)
+
+    return {
+        'hash': file_hash(filename),
+        'prologue': prologue,
+        'epilogue': epilogue,
+        'questions': [[q.text, q.mkdwn_text, q.answers, q.mkdwn_answers, q.comments] for q in poll],
+    }
+
+
+def build_question(source: str, number: int, entry: list, problems: list) -> Question:
+    """
+        Question из записи кэша с проверкой ограничений Telegram. Тексты в MarkdownV2 заменяются готовыми к отправке
+        (см. markdown_payload), все найденные ошибки пишутся в problems с ключом строки датасета
+    """
+    text, mkdwn_text, answers, mkdwn_answers, comments = entry
+
+    if len(text) > POLL_QUESTION_LIMIT:
+        problems.append((source, 'question{}'.format(number),
+            'длина {} больше {}, в опросе текст будет обрезан'.format(len(text), POLL_QUESTION_LIMIT)))
+    if sum(a is not None for a in answers) < 2:
+        problems.append((source, 'question{}'.format(number), 'меньше двух вариантов ответа, опрос не отправится'))
+
+    for n, answer in enumerate(answers, 1):
+        if answer is not None and len(answer) > POLL_OPTION_LIMIT:
+            problems.append((source, 'answer{}.{}'.format(number, n),
+                'длина {} больше {}, в опросе текст будет обрезан'.format(len(answer), POLL_OPTION_LIMIT)))
+
+    def payload(val, row):
+        #пустой комментарий - то же, что его отсутствие
+        if val is None or not val.strip():
+            return None
+        return markdown_payload(val, source, row.format(number), problems)
+
+    return Question(text,
+        payload(mkdwn_text, 'question{}') or '',
+        tuple(answers),
+        tuple(payload(a, 'answer{}.' + str(n)) for n, a in enumerate(mkdwn_answers, 1)),
+        tuple(payload(c, 'comment{}.' + str(n)) for n, c in enumerate(comments, 1)))
+
+
+def load_dataset(filename: str, name: str, cache: dict, snapshot):
+    """
+        датасет для опроса name: из кэша, если исходный файл не менялся, иначе - через pandas (и кэш обновляется).
+        Возвращает Poll, пролог и эпилог - уже проверенные и готовые к отправке
+    """
+    digest = file_hash(filename)
+    snapshot.sources[filename] = digest
+
+    entry = cache.get(filename)
+    if entry is None or entry['hash'] != digest:
+        entry = compile_dataset(filename)
+        cache[filename] = entry
+        snapshot.reparsed.add(filename)
+
+    #вопросы неизменяемы, поэтому для неизменившегося файла переиспользуем уже собранные
+    compiled = _compiled.get(filename)
+    if compiled is None or compiled[0] != digest:
+        problems = []
+        questions = tuple(build_question(filename, number, q, problems) for number, q in enumerate(entry['questions'], 1))
+        prologue = markdown_payload(entry['prologue'], filename, 'prologue', problems) if entry['prologue'] else ''
+        epilogue = markdown_payload(entry['epilogue'], filename, 'epilogue', problems) if entry['epilogue'] else ''
+        compiled = (digest, questions, prologue, epilogue, problems)
+        _compiled[filename] = compiled
+
+    _, questions, prologue, epilogue, problems = compiled
+    snapshot.problems.extend(problems)
+    return Poll(name, questions), prologue, epilogue
+
+
+def read_poll_config(node, snapshot, cache: dict):
+    for key, val in node.items():
+        if isinstance(val, dict):
+            snapshot.aligned_polls[key] = val.keys()
+            if '_prompt' in val.keys():
+                snapshot.poll_strings[key] = {'_prompt': val['_prompt']}
+
+            read_poll_config(val, snapshot, cache)
+
+        elif isinstance(val, str):
+            if  (val[:6] =='assets'): #это путь к датасету
+                poll, prologue, epilogue  = load_dataset(val, key, cache, snapshot)
+                
+                snapshot.poll_datasets[key] = poll
+                
+                if key not in snapshot.poll_strings.keys():
+                    snapshot.poll_strings[key] = {}
+                snapshot.poll_strings[key]['prologue'] = prologue
+                snapshot.poll_strings[key]['epilogue'] = epilogue 
+            
+            elif key == '_prompt':
+                continue
+            
+
+
+class ContentSnapshot():
+    """
+        срез всего контента бота. После сборки не меняется - при перезагрузке собирается новый срез
+    """
+
+    def __init__(self):
+        self.aligned_polls = {} #здесь не более 1 уровня вложенности. Ключ - имя пункта меню, значене - список с именами вложенных меню
+        self.poll_datasets = {} #базы с вопросами/ответами для самоаудита и квиза: имя опроса -> Poll
+        self.poll_strings = {} #строковые значения для опросников (например, приглашения)
+        self.emergency_dialogue = {} #дерево ответов для критичных ситуаций
+        self.sources = {} #все файлы, из которых собран срез: путь -> хэш содержимого
+        self.reparsed = set() #датасеты, которые пришлось разбирать через pandas
+        self.changed = set() #файлы, изменившиеся по сравнению с предыдущим срезом
+        self.problems = [] #ошибки контента: (файл, строка или ключ, описание). Такие тексты уже заменены безопасными
+
+
+_current = None
+_local = threading.local()
+_reload_lock = threading.Lock()
+_reload_listeners = []
+
+_dataset_cache = None #записи кэша датасетов: путь -> скомпилированная запись
+_compiled = {}        #собранные датасеты: путь -> (хэш файла, кортеж Question, пролог, эпилог, ошибки)
+_configs = {}         #разобранные конфиги: путь -> (хэш файла, содержимое)
+
+
+def _read_config(path: str, snapshot):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    snapshot.sources[path] = digest
+
+    cached = _configs.get(path)
+    if cached is None or cached[0] != digest:
+        cached = (digest, json.loads(raw.decode('utf-8')))
+        _configs[path] = cached
+    return cached[1]
+
+
+def build_snapshot(cache_path: str = CONTENT_CACHE) -> ContentSnapshot:
+    """
+        собирает новый срез. Неизменившиеся конфиги и датасеты берутся из памяти или из кэша на диске,
+        pandas нужен только для изменившихся датасетов. Если что-то пришлось разбирать, кэш на диске перезаписывается
+    """
+    global _dataset_cache
+    if _dataset_cache is None:
+        _dataset_cache = read_content_cache(cache_path)
+
+    snapshot = ContentSnapshot()
+    for path in POLL_CONFIGS:
+        read_poll_config(_read_config(path, snapshot), snapshot, _dataset_cache)
+
+    #теперь загрузим дерево ответов для критичных ситуаций
+    snapshot.emergency_dialogue = {situation: [markdown_payload(msg, EMERGENCY_CONFIG, '{} #{}'.format(situation, n), snapshot.problems)
+            for n, msg in enumerate(messages, 1)]
+        for situation, messages in _read_config(EMERGENCY_CONFIG, snapshot).items()}
+
+    previous = _current.sources if _current is not None else {}
+    snapshot.changed = {path for path, digest in snapshot.sources.items() if previous.get(path) != digest}
+
+    for source, row, error in snapshot.problems:
+        if source in snapshot.changed:
+            logger.warning('%s: %s: %s', source, row, error)
+
+    if snapshot.reparsed:
+        try:
+            write_content_cache(_dataset_cache, cache_path)
+        except OSError:
+            pass #файловая система только для чтения - просто работаем без кэша
+
+    return snapshot
+
+
+def load_content(cache_path: str = CONTENT_CACHE) -> ContentSnapshot:
+    """
+        собирает срез и делает его текущим
+    """
+    global _current
+    with _reload_lock:
+        _current = build_snapshot(cache_path)
+        return _current
+
+
+def current() -> ContentSnapshot:
+    """
+        срез, закреплённый за текущим потоком через pinned(), а если такого нет - текущий
+    """
+    return getattr(_local, 'snapshot', None) or _current
+
+
+@contextmanager
+def pinned():
+    """
+        закрепляет текущий срез за потоком до конца блока: даже если посередине обновления контент перезагрузят,
+        обработчик (и всё, что он вызывает) увидит один и тот же срез. Можно использовать как декоратор.
+        Вложенный вызов оставляет уже закреплённый срез
+    """
+    if getattr(_local, 'snapshot', None) is not None:
+        yield _local.snapshot
+        return
+
+    _local.snapshot = _current
+    try:
+        yield _local.snapshot
+    finally:
+        _local.snapshot = None
+
+
+def on_reload(callback):
+    """
+        callback(snapshot) вызывается после того, как новый срез стал текущим
+    """
+    _reload_listeners.append(callback)
+    return callback
+
+
+def reload() -> set:
+    """
+        перечитывает изменившиеся файлы и, если что-то изменилось, атомарно подменяет текущий срез.
+        Возвращает множество изменившихся файлов
+    """
+    global _current
+    with _reload_lock:
+        snapshot = build_snapshot()
+        if not snapshot.changed:
+            return set()
+
+        _current = snapshot
+
+    logger.info('content reloaded, changed: %s', ', '.join(sorted(snapshot.changed)))
+    for callback in _reload_listeners:
+        callback(snapshot)
+
+    return snapshot.changed
+
+
+def _mtimes(paths) -> dict:
+    rez = {}
+    for path in paths:
+        try:
+            rez[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            rez[path] = None
+    return rez
+
+
+def watch(interval: float):
+    """
+        запускает фоновый поток, который раз в interval секунд проверяет время изменения всех файлов контента
+        и перезагружает контент, если какой-то из них поменялся
+    """
+    def loop():
+        seen = _mtimes(current().sources)
+        while True:
+            time.sleep(interval)
+            now = _mtimes(current().sources)
+            if now == seen:
+                continue
+            try:
+                reload()
+            except Exception:
+                #например, файл сохранён наполовину или в нём ошибка - остаёмся на старом срезе
+                logger.exception('content reload failed')
+            seen = _mtimes(current().sources)
+
+    watcher = threading.Thread(target = loop, daemon = True)
+    watcher.start()
+    return watcher
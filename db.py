@@ -1,8 +1,38 @@
-import redis
 import json
-import os
 import hashlib 
-from config import UID_SALT 
+import threading
+import functools
+import atexit
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from config import UID_SALT, SESSIONS_CACHE_SIZE, STORAGE_BACKEND, REDIS_URL
+from cache import LRUCache
+from storage import RedisBackend, MemoryBackend, WatchError
+
+logger = logging.getLogger(__name__)
+
+def make_backend(name: str = STORAGE_BACKEND):
+    """
+        создаёт хранилище по имени из конфига: 'redis' или 'memory'
+    """
+    if name == 'redis':
+        return RedisBackend(REDIS_URL)
+    if name == 'memory':
+        return MemoryBackend()
+
+    raise ValueError('unknown storage backend: {}'.format(name))
+
+
+class _LazyConnection():
+    """
+        дескриптор для _redis: клиент хранилища берётся при первом обращении, а не при импорте модуля
+    """
+
+    def __get__(self, obj, owner):
+        return owner._backend.client
+
 
 class Redis_connection():
     """
@@ -10,20 +40,57 @@ class Redis_connection():
 
         Если синглтон станет бутылочным горлышком, можно будет сделать подключение полем экземлпяра:
         self._redis
-        
+
+        Само хранилище (Redis или память процесса) выбирается в config.STORAGE_BACKEND,
+        его можно подменить через Redis_connection.use_backend(...) - например, в тестах
     """
 
-    #_redis = redis.StrictRedis( host='localhost', decode_responses=True, port=6379, db=0)
-    _redis = redis.StrictRedis.from_url(os.environ.get("REDIS_URL"), decode_responses =True )  
+    _backend = make_backend()
+    _redis = _LazyConnection()
 
     def __init__(self):
         pass
 
+    @staticmethod
+    def use_backend(backend):
+        Redis_connection._backend = backend
+
+class SessionConflict(Exception):
+    """
+        сессию пользователя изменили параллельно, пока шла транзакция. Изменения транзакции не записаны
+    """
+    pass
+
+
+class _SessionTransaction():
+    """
+        состояние сессии внутри одной транзакции: прочитано из базы один раз, все изменения копятся в памяти
+    """
+
+    def __init__(self, fields: dict, answers: list, version: int):
+        self.fields = fields        # поле хэша -> раскодированное значение
+        self.answers = answers      # все данные ответы, включая добавленные в транзакции
+        self.version = version      # версия сессии на момент чтения
+        self.dirty = set()          # изменённые поля хэша
+        self.new_answers = []       # ответы, добавленные в транзакции
+        self.answers_reset = False  # список ответов нужно очистить перед добавлением новых
+        self.callbacks = []         # что выполнить после успешной записи (Session.after_commit)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.dirty or self.new_answers or self.answers_reset)
+
+
 class Session(Redis_connection):
     
     #"_redis" is inherited from base class
 
-    _sessions_cache = {}
+    #объекты сессий живут в памяти не дольше самой сессии в базе: вытесняются по размеру и по времени простоя
+    _sessions_cache = LRUCache(maxsize = SESSIONS_CACHE_SIZE, ttl = 86400)
+
+    #открытые транзакции текущего потока: соленый uid -> транзакция.
+    #Хранятся отдельно от объектов сессий, чтобы вытеснение объекта из кэша не теряло открытую транзакцию
+    _local = threading.local()
 
     def __init__(self, uid: str = '0', lifetime: int = 86400):
         """
@@ -34,12 +101,15 @@ class Session(Redis_connection):
                 
         self._lifetime = lifetime # по умолчанию сессия живет сутки
         self._uid = Session.salt_uid(uid)
+        self._migrated = False #старую раскладку ключей проверяем один раз за жизнь объекта
 
         
     @staticmethod
+    @functools.lru_cache(maxsize = SESSIONS_CACHE_SIZE)
     def salt_uid(uid: str) -> str:
         """
             подсолим UID чтобы даже в случае кражи базы (что маловероятно) нельзя было понять, кто обращался к боту
+            Результат запоминается: хэш для одного и того же пользователя считается на каждом обновлении
         """
         return hashlib.sha256((UID_SALT + uid).encode()).hexdigest()
 
@@ -49,55 +119,298 @@ class Session(Redis_connection):
         
         salted_uid = Session.salt_uid(_uid)
 
-        if salted_uid not in cls._sessions_cache.keys():
-            cls._sessions_cache[salted_uid] = Session(_uid)
+        return cls._sessions_cache.get_or_create(salted_uid, lambda: Session(_uid))
+
+    @classmethod
+    def cache_stats(cls) -> dict:
+        """
+            счётчики кэша сессий и кэша соленых uid
+        """
+        salt_info = Session.salt_uid.cache_info()
+
+        return {
+            'sessions': cls._sessions_cache.stats,
+            'salt_uid': {'size': salt_info.currsize, 'maxsize': salt_info.maxsize,
+                'hits': salt_info.hits, 'misses': salt_info.misses},
+        }
+
+    #все свойства сессии лежат в одном хэше user:{uid} - так они читаются за одно обращение к базе и живут одинаковое время
+    #соответствие: поле хэша -> значение по умолчанию
+    _FIELDS = {'level': 0, 'current_poll': '', 'poll_options': [], 'correct_answers': 0}
+
+    #служебное поле хэша: увеличивается при каждой записи в сессию. По нему транзакция узнаёт о параллельных изменениях
+    _VERSION_FIELD = 'version'
+
+    #поля из старых раскладок, которые переносятся при первом обращении к сессии
+    _LEGACY_FIELDS = ('level', 'current_poll', 'poll_options', 'poll_answers', 'correct_answers')
+
+    @property
+    def _key(self) -> str:
+        return 'user:{user}'.format(user = self._uid)
+
+    #данные ответы - отдельный список user:{uid}:answers. Ответ дописывается одним RPUSH, без чтения всего списка
+    #и без гонок между параллельными обновлениями одного пользователя. Элемент списка - строка "уровень:ответ"
+    @property
+    def _answers_key(self) -> str:
+        return 'user:{user}:answers'.format(user = self._uid)
+
+    @staticmethod
+    def _encode_answer(val: dict) -> str:
+        return '{level}:{answer}'.format(level = val['level'], answer = val['answer'])
+
+    @staticmethod
+    def _decode_answer(val: str) -> dict:
+        level, answer = val.split(':')
+        return {'level': int(level), 'answer': int(answer)}
+
+    @classmethod
+    def _decode_field(cls, field: str, raw):
+        if raw is None:
+            default = cls._FIELDS[field]
+            return list(default) if isinstance(default, list) else default
+
+        if field == 'poll_options':
+            return json.loads(raw)
+        if field == 'current_poll':
+            return str(raw)
+        return int(raw)
 
-        return cls._sessions_cache[salted_uid]    
+    @staticmethod
+    def _encode_field(field: str, val):
+        if field == 'poll_options':
+            return json.dumps(val)
+        return val
+
+    @property
+    def _tx(self):
+        """
+            транзакция, открытая в текущем потоке (или None)
+        """
+        return self._transactions().get(self._uid)
+
+    @classmethod
+    def _transactions(cls) -> dict:
+        if not hasattr(cls._local, 'tx'):
+            cls._local.tx = {}
+        return cls._local.tx
+
+    def _migrate_legacy(self):
+        """
+            переносит сессию из старых раскладок в текущую:
+             - отдельный ключ user:{uid}:* на каждое свойство
+             - JSON-список ответов в поле poll_answers хэша
+            Выполняется один раз на объект сессии: после переноса старые ключи и поля удаляются
+        """
+        if self._migrated:
+            return
+        self._migrated = True
+
+        pipe = self._redis.pipeline()
+        pipe.exists(self._key)
+        pipe.hget(self._key, 'poll_answers')
+        hash_exists, hash_answers = pipe.execute()
+
+        legacy_keys = []
+        legacy = {}
+        if not hash_exists:
+            legacy_keys = ['{key}:{field}'.format(key = self._key, field = field) for field in self._LEGACY_FIELDS]
+            legacy_vals = self._redis.mget(legacy_keys)
+            legacy = {field: val for field, val in zip(self._LEGACY_FIELDS, legacy_vals) if val is not None}
+            if not legacy:
+                return
+        elif hash_answers is None:
+            return
+
+        answers = legacy.pop('poll_answers', hash_answers)
+
+        pipe = self._redis.pipeline()
+        if legacy:
+            pipe.hset(self._key, mapping = legacy)
+            pipe.expire(self._key, self._lifetime)
+        if legacy_keys:
+            pipe.unlink(*legacy_keys)
+        pipe.hdel(self._key, 'poll_answers')
+
+        answers = [self._encode_answer(a) for a in json.loads(answers)] if answers is not None else []
+        if answers:
+            pipe.unlink(self._answers_key)
+            pipe.rpush(self._answers_key, *answers)
+            pipe.expire(self._answers_key, self._lifetime)
+        pipe.execute()
+
+    def _get(self, field: str):
+        tx = self._tx
+        if tx is not None:
+            return tx.fields[field]
+
+        self._migrate_legacy()
+        return self._decode_field(field, self._redis.hget(self._key, field))
+
+    def _set(self, field: str, val):
+        tx = self._tx
+        if tx is not None:
+            tx.fields[field] = val
+            tx.dirty.add(field)
+            return
+
+        self._save({field: self._encode_field(field, val)})
+
+    def _save(self, fields: dict, reset_answers: bool = False):
+        """
+            записывает поля хэша и продлевает срок жизни сессии - одним пайплайном
+            reset_answers - заодно забыть все данные ответы
+        """
+        self._migrate_legacy()
+
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key, mapping = fields)
+        pipe.hincrby(self._key, self._VERSION_FIELD, 1)
+        pipe.expire(self._key, self._lifetime)
+        if reset_answers:
+            pipe.unlink(self._answers_key)
+        else:
+            pipe.expire(self._answers_key, self._lifetime)
+        pipe.execute()
+
+    def _read_raw(self):
+        """
+            читает хэш и список ответов за одно обращение к базе (HGETALL + LRANGE в одном пайплайне)
+        """
+        self._migrate_legacy()
+
+        pipe = self._redis.pipeline(transaction = False)
+        pipe.hgetall(self._key)
+        pipe.lrange(self._answers_key, 0, -1)
+        raw, answers = pipe.execute()
+
+        return raw, [self._decode_answer(a) for a in answers]
+
+    def load(self) -> dict:
+        """
+            читает все свойства сессии за одно обращение к базе.
+            Возвращает словарь с ключами poll_level, current_poll, poll_options, poll_answers, correct_answers_count
+        """
+        tx = self._tx
+        if tx is not None:
+            fields, answers = tx.fields, tx.answers
+        else:
+            raw, answers = self._read_raw()
+            fields = {field: self._decode_field(field, raw.get(field)) for field in self._FIELDS}
+
+        return {
+            'poll_level': fields['level'],
+            'current_poll': fields['current_poll'],
+            'poll_options': list(fields['poll_options']),
+            'poll_answers': list(answers),
+            'correct_answers_count': fields['correct_answers'],
+        }
+
+    @contextmanager
+    def transaction(self):
+        """
+            единица работы над сессией в рамках одного обновления:
+
+                with session.transaction():
+                    level = session.poll_level
+                    ...
+
+            Состояние читается из базы один раз при входе, чтения и записи внутри блока идут в память,
+            а все изменения пишутся одним MULTI/EXEC при выходе.
+            Если сессию параллельно изменили (сменилась версия или сработал WATCH), бросается SessionConflict,
+            изменения транзакции при этом не записываются. При исключении внутри блока изменения тоже отбрасываются.
+
+            Вложенный вызов в том же потоке просто работает внутри уже открытой транзакции
+        """
+        if self._tx is not None:
+            yield self
+            return
+
+        raw, answers = self._read_raw()
+        fields = {field: self._decode_field(field, raw.get(field)) for field in self._FIELDS}
+        tx = _SessionTransaction(fields, answers, int(raw.get(self._VERSION_FIELD, 0)))
+        self._transactions()[self._uid] = tx
+
+        try:
+            yield self
+            self._commit(tx)
+        finally:
+            del self._transactions()[self._uid]
+
+        for callback in tx.callbacks:
+            callback()
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._tx is not None
+
+    def after_commit(self, callback):
+        """
+            callback() выполнится после того, как транзакция запишется в базу, и не выполнится, если запись не удалась.
+            Вне транзакции выполняется сразу
+        """
+        tx = self._tx
+        if tx is None:
+            callback()
+            return
+        tx.callbacks.append(callback)
+
+    def _commit(self, tx: _SessionTransaction):
+        if not tx.changed:
+            return
+
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(self._key)
+                version = pipe.hget(self._key, self._VERSION_FIELD)
+                if int(version or 0) != tx.version:
+                    raise SessionConflict('session {user} changed since version {v}'.format(user = self._uid, v = tx.version))
+
+                pipe.multi()
+                if tx.dirty:
+                    pipe.hset(self._key, mapping = {field: self._encode_field(field, tx.fields[field]) for field in tx.dirty})
+                pipe.hincrby(self._key, self._VERSION_FIELD, 1)
+                pipe.expire(self._key, self._lifetime)
+                if tx.answers_reset:
+                    pipe.unlink(self._answers_key)
+                if tx.new_answers:
+                    pipe.rpush(self._answers_key, *[self._encode_answer(a) for a in tx.new_answers])
+                pipe.expire(self._answers_key, self._lifetime)
+                pipe.execute()
+            except WatchError:
+                raise SessionConflict('session {user} changed during commit'.format(user = self._uid))
 
     @property
     def poll_level(self) -> int:
         """
             номер текущего вопроса
         """
-        l = self._redis.get('user:{user}:level'.format(user = self._uid ))
-        return int (l) if l is not None else 0
+        return self._get('level')
 
     @poll_level.setter
     def poll_level(self, val:int):
-        self._redis.set('user:{user}:level'.format(user = self._uid ),
-            val,
-            ex = self._lifetime)
+        self._set('level', val)
 
     @property
     def current_poll(self)  -> str:
         """
             Имя текущего опроса. Нужно для выбора правильного датасета с вопросами
         """
-        
-        
-        p = self._redis.get('user:{user}:current_poll'.format(user = self._uid ))
-        return str(p) if p is not None else ''
+        return self._get('current_poll')
 
     @current_poll.setter
     def current_poll(self, val: str):
-        self._redis.set('user:{user}:current_poll'.format(user = self._uid ),
-            val,
-            ex = self._lifetime)
+        self._set('current_poll', val)
 
     @property
     def poll_options(self) -> list:
         """
             Сохранённые варианты ответа на последний опрос. Нужны, чтобы идентифицировать правильный ответ
         """
-        
-        p = self._redis.get('user:{user}:poll_options'.format(user = self._uid ))
-        return json.loads(p) if p is not None else []
+        return self._get('poll_options')
 
     @poll_options.setter
     def poll_options(self, val: list):
-        self._redis.set('user:{user}:poll_options'.format(user = self._uid ),
-            json.dumps(val),
-            ex = self._lifetime)
+        self._set('poll_options', list(val))
 
 
     @property
@@ -108,29 +421,50 @@ class Session(Redis_connection):
 
            Для добавления ответа используйте метод memorize_answer({'уровень':'ответ'})
         """
-        p = self._redis.get('user:{user}:poll_answers'.format(user = self._uid ))
-        return json.loads(p) if p is not None else []
+        tx = self._tx
+        if tx is not None:
+            return list(tx.answers)
+
+        self._migrate_legacy()
+        return [self._decode_answer(a) for a in self._redis.lrange(self._answers_key, 0, -1)]
 
     def memorize_answer(self, val: dict):
         """
             Добавить пару уровень-ответ в список выданных ответов
         """
+        tx = self._tx
+        if tx is not None:
+            tx.answers.append(val)
+            tx.new_answers.append(val)
+            return
+
+        self._migrate_legacy()
 
-        answers = self.poll_answers
-        answers.append(val)
-        self._redis.set('user:{user}:poll_answers'.format(user = self._uid)
-            ,json.dumps(answers)
-            ,ex = self._lifetime
-        )
+        pipe = self._redis.pipeline()
+        pipe.rpush(self._answers_key, self._encode_answer(val))
+        pipe.hincrby(self._key, self._VERSION_FIELD, 1)
+        pipe.expire(self._answers_key, self._lifetime)
+        pipe.expire(self._key, self._lifetime)
+        pipe.execute()
 
     def _reset_answers(self):
         """
             забудем все данные ответы
         """
-        self._redis.set('user:{user}:poll_answers'.format(user = self._uid)
-            ,json.dumps([])
-            ,ex = self._lifetime
-        )
+        tx = self._tx
+        if tx is not None:
+            tx.answers = []
+            tx.new_answers = []
+            tx.answers_reset = True
+            return
+
+        self._migrate_legacy()
+
+        pipe = self._redis.pipeline()
+        pipe.unlink(self._answers_key)
+        pipe.hincrby(self._key, self._VERSION_FIELD, 1)
+        pipe.expire(self._key, self._lifetime)
+        pipe.execute()
 
 
     @property
@@ -138,19 +472,27 @@ class Session(Redis_connection):
         """
             число правильных ответов (или очков)  в опросе
         """
-        p = self._redis.get('user:{user}:correct_answers'.format(user = self._uid ))
-        return int(p) if p is not None else 0
+        return self._get('correct_answers')
 
     def reckon_correct_answer(self):
         """
             увеличить счётчик правильных ответов на 1
         """
-        self._redis.incr('user:{user}:correct_answers'.format(user = self._uid ), 1)
+        tx = self._tx
+        if tx is not None:
+            self._set('correct_answers', tx.fields['correct_answers'] + 1)
+            return
+
+        self._migrate_legacy()
+
+        pipe = self._redis.pipeline()
+        pipe.hincrby(self._key, 'correct_answers', 1)
+        pipe.hincrby(self._key, self._VERSION_FIELD, 1)
+        pipe.expire(self._key, self._lifetime)
+        pipe.execute()
 
     def _reset_correct_answers_counter(self):
-        self._redis.set('user:{user}:correct_answers'.format(user = self._uid )
-            ,0 
-            ,ex = self._lifetime)
+        self._set('correct_answers', 0)
 
 
     def reset(self):
@@ -158,18 +500,52 @@ class Session(Redis_connection):
             принудительно сбрасывает все свойства сессии
         """
 
-        #можно было бы удалить ключи, но они скорее всего сразу же заполнятся заново - пользователь выберет следующий опрос 
-        # поэтому просто заполним существующие ключи пустыми значениями
+        #можно было бы удалить ключ, но он скорее всего сразу же заполнится заново - пользователь выберет следующий опрос 
+        # поэтому просто заполним все поля пустыми значениями - одной записью в хэш
+
+        if self._tx is not None:
+            for field in self._FIELDS:
+                self._set(field, self._decode_field(field, None))
+            self._reset_answers()
+            return
 
-        self.poll_level = 0
-        self.current_poll = ''
-        self.poll_options = [] 
-        self._reset_answers()
-        self._reset_correct_answers_counter()
+        self._save({field: self._encode_field(field, self._decode_field(field, None)) for field in self._FIELDS},
+            reset_answers = True)
 
     
 
 
+class _StatsBatch():
+    """
+        приращения статистики, которые ещё не записаны в базу
+    """
+
+    def __init__(self):
+        self.counters = Counter()      # (ключ опроса, поле счётчика) -> приращение
+        self.rollups = Counter()       # (ключ опроса, 'hour' или 'day', корзина) -> приращение
+        self.users = defaultdict(set)  # (ключ опроса, 'hour' или 'day' или None для всего времени, корзина) -> соленые uid
+        self.size = 0
+
+    def add(self, poll_key: str, field: str, when: datetime, user: str = None):
+        self.counters[(poll_key, field)] += 1
+        hour = when.strftime(Statistics._HOUR_FORMAT)
+        day = when.strftime(Statistics._DAY_FORMAT)
+        self.rollups[(poll_key, 'hour', hour)] += 1
+        self.rollups[(poll_key, 'day', day)] += 1
+        if user is not None:
+            self.users[(poll_key, 'hour', hour)].add(user)
+            self.users[(poll_key, 'day', day)].add(user)
+            self.users[(poll_key, None, None)].add(user)
+        self.size += 1
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        self.rollups.update(other.rollups)
+        for key, users in other.users.items():
+            self.users[key] |= users
+        self.size += other.size
+
+
 class Statistics(Redis_connection):
     """
         Класс для учёта статистики ответов на опросы/квизы
@@ -179,15 +555,43 @@ class Statistics(Redis_connection):
 
     _poll_keys = {} #соответствие имён опросов и ключей в базе редиса. Локальный кэш, чтобы лишний раз не ходить в базу
 
-    def __init__(self, polls=[] ):
+    def __init__(self, polls=[], flush_interval: float = 0, flush_size: int = 500 ):
         """
             polls - можно  передать список с именами опросов, чтобы сразу заполнить кэш и инициализировать ключи в редисе 
+            flush_interval - если больше 0, ответы копятся в памяти процесса и пишутся в базу пачкой раз в flush_interval секунд.
+                0 - каждый ответ сразу пишется в базу
+            flush_size - в режиме накопления: сколько ответов накопить, чтобы записать пачку, не дожидаясь таймера
         """
         super().__init__()
 
-        for poll in polls:
-            self._get_poll_key(poll)
+        self._pending = _StatsBatch()
+        self._pending_lock = threading.Lock()
+        self._flush_size = flush_size
+        self._buffered = flush_interval > 0
+        self._stopped = threading.Event()
 
+        if self._buffered:
+            flusher = threading.Thread(target = self._flush_loop, args = (flush_interval,), daemon = True)
+            flusher.start()
+            atexit.register(self.close) #накопленное не должно пропасть при остановке бота
+
+        polls = list(polls)
+        if polls:
+            self.warm_up(polls)
+
+
+    def warm_up(self, poll_names: list):
+        """
+            заполняет кэш ключей для списка опросов одним HMGET. Новые опросы сразу регистрируются
+        """
+        
+        #в recorder_polls лежит "вывернутая" структура: имя опроса -> ключ Redis
+        #внутри этого ключа будут храниться ответы на опрос
+        for poll_name, poll_key in zip(poll_names, self._redis.hmget('polls:recorded_polls', poll_names)):
+            if poll_key is not None:
+                self._poll_keys[poll_name] = poll_key
+            else:
+                self._register_poll(poll_name)
 
     def _get_poll_key(self, poll_name: str) -> str:
         """
@@ -199,58 +603,268 @@ class Statistics(Redis_connection):
             return  self._poll_keys[poll_name]
 
         #не нашли в кэше, посмотрим в БД
-        
-        #в recorder_polls лежит "вывернутая" структура: имя опроса -> ключ Redis
-        #внутри этого ключа будут храниться ответы на опрос
-        db_polls = self._redis.hgetall('polls:recorded_polls')
-        if poll_name in db_polls.keys():
-            poll_key = db_polls[poll_name] 
+        poll_key = self._redis.hget('polls:recorded_polls', poll_name)
+        if poll_key is not None:
             self._poll_keys[poll_name] = poll_key
             return poll_key
 
         #ничего не нашли. добавим новый ключ в базу
-        poll_key = 'poll{}'.format(len(db_polls)) #постоянно увеличиваем номер ключа. Начинаем с 0
-        self._redis.hset('polls:recorded_polls', poll_name, poll_key) #отметимся в списке ключей
-        self._redis.hset('polls:{}'.format(poll_key), 'name', poll_name) #а теперь создадим "куст", куда будет записываться статистика по ответам
+        return self._register_poll(poll_name)
+
+    def _init_poll_sequence(self):
+        """
+            счётчик polls:poll_seq выдаёт номера новых ключей. Раньше номер считался по числу опросов в базе,
+            поэтому при первом запуске счётчик начинается сразу за самым большим из уже выданных номеров
+        """
+        if self._redis.exists('polls:poll_seq'):
+            return
+
+        issued = [int(poll_key[len('poll'):]) for poll_key in self._redis.hgetall('polls:recorded_polls').values()]
+        #если счётчик параллельно создал другой процесс, его значение не трогаем
+        self._redis.set('polls:poll_seq', max(issued) + 1 if issued else 0, nx = True)
+
+    def _register_poll(self, poll_name: str) -> str:
+        """
+            выдаёт опросу новый ключ. Номер берётся атомарным INCR, а привязка имени - через HSETNX:
+            если два процесса регистрируют один опрос одновременно, оба получат ключ того, кто успел первым
+        """
+        self._init_poll_sequence()
+
+        poll_key = 'poll{}'.format(self._redis.incr('polls:poll_seq') - 1) #постоянно увеличиваем номер ключа. Начинаем с 0
+        if self._redis.hsetnx('polls:recorded_polls', poll_name, poll_key): #отметимся в списке ключей
+            self._redis.hset(self._meta_key(poll_key), 'name', poll_name) #а теперь создадим "куст", куда будет записываться статистика по ответам
+        else:
+            #кто-то успел раньше - берём его ключ, а наш номер просто пропадает
+            poll_key = self._redis.hget('polls:recorded_polls', poll_name)
+
         self._poll_keys[poll_name] = poll_key #и кэш тоже не забываем
 
         return poll_key
 
 
-    def reckon_answer(self, poll_name: str, round_number: int, answer_number: int):
+    #счётчики ответов опроса лежат в одном хэше polls:{key}:counters, поле - "q{номер вопроса}:a{номер ответа}".
+    #Так отчёт по опросу читается одним HGETALL, без обхода всей базы
+    @staticmethod
+    def _counters_key(poll_key: str) -> str:
+        return 'polls:{key}:counters'.format(key = poll_key)
+
+    @staticmethod
+    def _counter_field(round_number: int, answer_number: int) -> str:
+        return 'q{r_number}:a{a_number}'.format(r_number = round_number, a_number = answer_number)
+
+    #итоги: общее число ответов - строковый счётчик, по опросу - поле answers_total в хэше опроса polls:{key}.
+    #Увеличиваются в одной транзакции со счётчиком ответа, поэтому читаются за O(1) без обхода счётчиков
+    _TOTAL_KEY = 'polls:answers_total'
+    _POLL_TOTAL_FIELD = 'answers_total'
+
+    @staticmethod
+    def _meta_key(poll_key: str) -> str:
+        return 'polls:{key}'.format(key = poll_key)
+
+    #динамика по времени: число ответов по часам и по дням - строковые счётчики polls:{key}:hour:{ГГГГММДДЧЧ}
+    #и polls:{key}:day:{ГГГГММДД}, уникальные пользователи - HyperLogLog polls:{key}:users:{ГГГГММДД} по дням,
+    #polls:{key}:users:hour:{ГГГГММДДЧЧ} по часам (только для отчёта за сутки, поэтому живут недолго)
+    #и polls:{key}:users за всё время. Время - UTC. Корзины живут ограниченное время, диапазон читается
+    #одним MGET/PFCOUNT по заранее вычисленным именам ключей, без обхода базы
+    _HOUR_FORMAT = '%Y%m%d%H'
+    _DAY_FORMAT = '%Y%m%d'
+    _RETENTION = {'hour': 14 * 86400, 'day': 400 * 86400}
+    _USERS_RETENTION = {'hour': 2 * 86400, 'day': 400 * 86400}
+
+    @staticmethod
+    def _rollup_key(poll_key: str, granularity: str, bucket: str) -> str:
+        return 'polls:{key}:{granularity}:{bucket}'.format(key = poll_key, granularity = granularity, bucket = bucket)
+
+    @staticmethod
+    def _users_key(poll_key: str, bucket: str = None, granularity: str = 'day') -> str:
+        if bucket is None:
+            return 'polls:{key}:users'.format(key = poll_key)
+        if granularity == 'hour':
+            return 'polls:{key}:users:hour:{hour}'.format(key = poll_key, hour = bucket)
+        return 'polls:{key}:users:{day}'.format(key = poll_key, day = bucket)
+
+    def reckon_answer(self, poll_name: str, round_number: int, answer_number: int, user: str = None, when: datetime = None):
         """
             учесть выбор в опросе/квизе
 
             poll_name - имя опроса (из конфига или из свойства current_poll)
             round_number - номер вопроса из опроса
             answer_number - номер выбранного ответа
+            user - соленый uid пользователя (Session.salt_uid) для подсчёта уникальных пользователей
+            when - время ответа, по умолчанию - сейчас
         """
 
         poll_key = self._get_poll_key(poll_name)
-        self._redis.incr('polls:{key}:question{r_number}:answer{a_number}'.format(
-            key = poll_key,
-            r_number = round_number,
-            a_number = answer_number
-        ))
+        when = when or datetime.now(timezone.utc)
 
-    def reset(self):
+        if not self._buffered:
+            batch = _StatsBatch()
+            batch.add(poll_key, self._counter_field(round_number, answer_number), when, user)
+            self._write_batch(batch)
+            return
+
+        with self._pending_lock:
+            self._pending.add(poll_key, self._counter_field(round_number, answer_number), when, user)
+            full = self._pending.size >= self._flush_size
+
+        if full:
+            self.flush()
+
+    def _write_batch(self, batch: _StatsBatch):
         """
-            сбросить счетчики по всем ответам
+            записывает приращения счётчиков, итогов и корзин по времени одним MULTI/EXEC
         """
+        poll_totals = Counter()
+
+        pipe = self._redis.pipeline()
+        for (poll_key, field), cnt in batch.counters.items():
+            pipe.hincrby(self._counters_key(poll_key), field, cnt)
+            poll_totals[poll_key] += cnt
+        for poll_key, cnt in poll_totals.items():
+            pipe.hincrby(self._meta_key(poll_key), self._POLL_TOTAL_FIELD, cnt)
+        pipe.incr(self._TOTAL_KEY, sum(poll_totals.values()))
+
+        for (poll_key, granularity, bucket), cnt in batch.rollups.items():
+            key = self._rollup_key(poll_key, granularity, bucket)
+            pipe.incr(key, cnt)
+            pipe.expire(key, self._RETENTION[granularity])
+        for (poll_key, granularity, bucket), users in batch.users.items():
+            key = self._users_key(poll_key, bucket, granularity)
+            pipe.pfadd(key, *users)
+            if granularity is not None:
+                pipe.expire(key, self._USERS_RETENTION[granularity])
+
+        pipe.execute()
+
+    def flush(self):
+        """
+            записать в базу всё, что накопилось в памяти. Если запись не удалась, накопленное возвращается в буфер
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, _StatsBatch()
+
+        if not pending.size:
+            return
+
+        try:
+            self._write_batch(pending)
+        except Exception:
+            with self._pending_lock:
+                self._pending.merge(pending)
+            raise
+
+    def _flush_loop(self, interval: float):
+        while not self._stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('statistics flush failed, will retry')
+
+    def close(self):
+        """
+            остановить фоновую запись и сбросить в базу остатки
+        """
+        self._stopped.set()
+        self.flush()
+
+    def migrate_legacy_counters(self, chunk_size: int = 500) -> int:
+        """
+            разовый перенос счётчиков из старой раскладки (строковый ключ polls:pollN:questionX:answerY на каждый ответ)
+            в хэши polls:pollN:counters. Старые ключи удаляются.
+            После переноса ставится отметка polls:migrated:counters, и повторный вызов ничего не делает.
+
+            Возвращает число перенесённых ключей
+        """
+
+        if self._redis.exists('polls:migrated:counters'):
+            return 0
 
-        CHUNK_SIZE = 100
+        moved = 0
+        moved_in_pass = None
+        while moved_in_pass != 0:
+            #ключи удаляются прямо во время обхода, поэтому проходим, пока очередной проход не найдёт ничего
+            moved_in_pass = 0
+            for keys in self._scan_chunks('polls:poll*:question*:answer*', chunk_size):
+                vals = self._redis.mget(keys)
+
+                #новые версии бота в старые ключи не пишут, поэтому между чтением и удалением значения не поменяются
+                pipe = self._redis.pipeline()
+                for key, val in zip(keys, vals):
+                    #пример ключа
+                    # polls:poll0:question0:answer3
+                    _, poll_key, questionN, answerN = key.split(':')
+                    if val not in (None, ''):
+                        pipe.hincrby(self._counters_key(poll_key),
+                            self._counter_field(questionN[len('question'):], answerN[len('answer'):]), int(val))
+                        pipe.hincrby(self._meta_key(poll_key), self._POLL_TOTAL_FIELD, int(val))
+                        pipe.incr(self._TOTAL_KEY, int(val))
+                    pipe.unlink(key)
+                pipe.execute()
+                moved_in_pass += len(keys)
+
+            moved += moved_in_pass
+
+        self._redis.set('polls:migrated:counters', 1)
+        return moved
+
+    def _scan_chunks(self, match: str, chunk_size: int):
+        """
+            обходит ключи по шаблону порциями (SCAN), пустые порции пропускает
+        """
         cursor = None
         while cursor != 0:
-            #удаляем только ключи со статистикой ответов. 
-            #метаключи с именем опроса не трогаем: если удалять их, придётся синхронизировать данные с кэшем в памяти питона,
-            # накладывать блокировку, чтобы параллельные пользователи не меняли данные удаляемых ключей... 
-            # Слишком много проблем, проще оставить их на месте - при необходимости, можно почистить вручную во время планового даунтайма
-            cursor, keys  = self._redis.scan(cursor= cursor or 0, match= 'polls:poll*:question*', count= CHUNK_SIZE)
-            pipe = self._redis.pipeline()
+            cursor, keys = self._redis.scan(cursor= cursor or 0, match= match, count= chunk_size)
+            if keys:
+                yield keys
+
+    def reset(self):
+        """
+            сбросить счетчики по всем ответам
+        """
 
-            for key in keys:
-                pipe.unlink(key)
-            pipe.execute()
+        #удаляем только хэши со статистикой ответов. 
+        #метаключи с именем опроса не трогаем: если удалять их, придётся синхронизировать данные с кэшем в памяти питона,
+        # накладывать блокировку, чтобы параллельные пользователи не меняли данные удаляемых ключей... 
+        # Слишком много проблем, проще оставить их на месте - при необходимости, можно почистить вручную во время планового даунтайма
+        poll_keys = self._redis.hgetall('polls:recorded_polls').values()
+
+        pipe = self._redis.pipeline()
+        for poll_key in poll_keys:
+            pipe.unlink(self._counters_key(poll_key))
+            pipe.hdel(self._meta_key(poll_key), self._POLL_TOTAL_FIELD)
+        pipe.unlink(self._TOTAL_KEY)
+        pipe.execute()
+
+    def reconcile_totals(self, force: bool = True) -> int:
+        """
+            пересчитывает итоги (общий и по каждому опросу) по самим счётчикам ответов.
+            force=False - пересчитать, только если общего итога ещё нет в базе (например, сразу после обновления бота)
+
+            Возвращает общее число ответов
+        """
+
+        if not force and self._redis.exists(self._TOTAL_KEY):
+            return self.get_all_answers_count()
+
+        poll_keys = list(self._redis.hgetall('polls:recorded_polls').values())
+        counters_keys = [self._counters_key(poll_key) for poll_key in poll_keys]
+
+        with self._redis.pipeline() as pipe:
+            while True:
+                try:
+                    #если пока считаем, кто-то ответит на опрос - пересчитаем заново
+                    if counters_keys:
+                        pipe.watch(*counters_keys)
+                    totals = [sum(int(v) for v in pipe.hgetall(key).values()) for key in counters_keys]
+
+                    pipe.multi()
+                    for poll_key, total in zip(poll_keys, totals):
+                        pipe.hset(self._meta_key(poll_key), self._POLL_TOTAL_FIELD, total)
+                    pipe.set(self._TOTAL_KEY, sum(totals))
+                    pipe.execute()
+                    return sum(totals)
+                except WatchError:
+                    continue
 
     @property
     def saved_polls(self)->list: 
@@ -268,34 +882,106 @@ class Statistics(Redis_connection):
             }
         """
 
+        self.flush() #чтобы в отчёт попали и ответы, ещё не записанные в базу
+
         rez = {}
 
         poll_key = self._get_poll_key(poll_name)
-        for key in self._redis.scan_iter('polls:{poll_key}:*'.format(poll_key= poll_key), _type='STRING'):
-            #пример ключа
-            # polls:poll0:question0:answer3   
-              
-            questionN = key.split(':')[-2]
-            answerN   = key.split(':')[-1]
-            val = int( self._redis.get(key)) if self._redis.get(key) !='' else 0
+        for field, val in self._redis.hgetall(self._counters_key(poll_key)).items():
+            #пример поля
+            # q0:a3
+            questionN, answerN = field.split(':')
+            questionN = 'question{}'.format(questionN[1:])
+            answerN = 'answer{}'.format(answerN[1:])
 
             if questionN not in rez.keys():
                 rez[questionN] = {}
-            rez[questionN][answerN] = val
+            rez[questionN][answerN] = int(val)
         
         return rez
 
+    def iter_counters(self, chunk_size: int = 500):
+        """
+            потоково обходит счётчики всех опросов, выдаёт кортежи
+            (имя опроса, номер вопроса, номер ответа, число выборов).
+            Счётчики читаются порциями через HSCAN вместе со значениями, в памяти одновременно - не больше одной порции
+        """
+        self.flush()
+
+        for poll_name, poll_key in self._redis.hgetall('polls:recorded_polls').items():
+            for field, val in self._redis.hscan_iter(self._counters_key(poll_key), count = chunk_size):
+                #пример поля
+                # q0:a3
+                questionN, answerN = field.split(':')
+                yield poll_name, int(questionN[1:]), int(answerN[1:]), int(val)
+
     def get_all_answers_count(self)->int: 
+        """
+            общее число ответов во всех опросах
+        """
+        self.flush()
+        rez = self._redis.get(self._TOTAL_KEY)
+        return int(rez) if rez is not None else 0
 
-        rez = 0
-        for key in  self._redis.scan_iter('polls:poll*:question*:answer*', _type='STRING'):
-            v = self._redis.get(key)
-            if v!='':
-                rez += int(v)
+    def get_poll_answers_count(self, poll_name: str)->int:
+        """
+            число ответов в одном опросе
+        """
+        self.flush()
+        rez = self._redis.hget(self._meta_key(self._get_poll_key(poll_name)), self._POLL_TOTAL_FIELD)
+        return int(rez) if rez is not None else 0
+
+    def _buckets(self, since: datetime, until: datetime, granularity: str) -> list:
+        """
+            моменты начала корзин (часов или дней) в диапазоне [since, until]
+        """
+        if granularity == 'hour':
+            step = timedelta(hours = 1)
+            start = since.replace(minute = 0, second = 0, microsecond = 0)
+        else:
+            step = timedelta(days = 1)
+            start = since.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
 
+        rez = []
+        while start <= until:
+            rez.append(start)
+            start += step
         return rez
 
+    def get_answers_timeline(self, poll_name: str, since: datetime, until: datetime = None, granularity: str = 'day') -> list:
+        """
+            число ответов в опросе по часам (granularity='hour') или дням ('day') за диапазон времени (UTC).
+            Возвращает список пар (начало корзины, число ответов). Читается одним MGET
+        """
+        self.flush()
 
+        until = until or datetime.now(timezone.utc)
+        fmt = self._HOUR_FORMAT if granularity == 'hour' else self._DAY_FORMAT
+        poll_key = self._get_poll_key(poll_name)
 
+        buckets = self._buckets(since, until, granularity)
+        if not buckets:
+            return []
 
-        
+        vals = self._redis.mget([self._rollup_key(poll_key, granularity, b.strftime(fmt)) for b in buckets])
+        return [(b, int(v) if v is not None else 0) for b, v in zip(buckets, vals)]
+
+    def get_unique_users(self, poll_name: str, since: datetime = None, until: datetime = None, granularity: str = 'day') -> int:
+        """
+            оценка числа разных пользователей, отвечавших в опросе (HyperLogLog, погрешность около 1%).
+            since=None - за всё время, иначе - по часам (granularity='hour', не дальше двух суток назад)
+            или дням ('day') UTC, которые задевает диапазон - те же корзины, что у get_answers_timeline.
+            Читается одним PFCOUNT
+        """
+        self.flush()
+
+        poll_key = self._get_poll_key(poll_name)
+        if since is None:
+            return self._redis.pfcount(self._users_key(poll_key))
+
+        until = until or datetime.now(timezone.utc)
+        fmt = self._HOUR_FORMAT if granularity == 'hour' else self._DAY_FORMAT
+        buckets = self._buckets(since, until, granularity)
+        if not buckets:
+            return 0
+        return self._redis.pfcount(*[self._users_key(poll_key, b.strftime(fmt), granularity) for b in buckets])
@@ -0,0 +1,95 @@
+"""
+    Защита от повторной обработки обновлений.
+
+    Telegram доставляет обновление повторно, если вебхук ответил слишком поздно или инстанс перезапустился,
+    воркер потоков Redis может повторить обновление после падения. Повторно обработанный ответ на опрос
+    второй раз попал бы в статистику и сдвинул бы пользователя на лишний вопрос, поэтому обновление,
+    чей update_id уже обработан, отбрасывается до всех обработчиков.
+
+    Обработанные update_id помнятся либо в Redis (ключ с TTL - общий для всех процессов и переживает перезапуск),
+    либо в кольце последних N id в памяти процесса - для одного инстанса с хранилищем в памяти.
+
+    update_id запоминается после обработки, а не до неё: если обработка упала, повторная доставка не потеряется.
+    Гонки между проверкой и записью нет - обновления одного пользователя (а значит, и повторы одного обновления)
+    обрабатываются строго по очереди, в одной дорожке dispatcher или в одной партиции воркера.
+"""
+
+import logging
+import threading
+from collections import deque
+
+from db import Redis_connection
+from storage import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator(Redis_connection):
+    """
+        shared=True - обработанные update_id хранятся в Redis ttl секунд, иначе - последние ring_size штук в памяти
+    """
+
+    def __init__(self, shared: bool = True, ttl: int = 3600, ring_size: int = 10000):
+        super().__init__()
+        self._shared = shared
+        self._ttl = ttl
+        self._ring = deque(maxlen = ring_size)
+        self._ring_ids = set()
+        self._lock = threading.Lock()
+        self._counters = {'checked': 0, 'duplicates': 0, 'errors': 0}
+
+    @staticmethod
+    def key(update_id: int) -> str:
+        return 'update:{}:done'.format(update_id)
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def seen(self, update_id: int) -> bool:
+        """
+            обновление уже обработано. Если Redis недоступен - считаем, что нет: лучше обработать повтор, чем потерять обновление
+        """
+        if self._shared:
+            try:
+                duplicate = bool(self._redis.exists(self.key(update_id)))
+            except RedisError:
+                logger.exception('cannot check update %s for duplicates', update_id)
+                self._count('errors')
+                duplicate = False
+        else:
+            with self._lock:
+                duplicate = update_id in self._ring_ids
+
+        with self._lock:
+            self._counters['checked'] += 1
+            if duplicate:
+                self._counters['duplicates'] += 1
+        return duplicate
+
+    def remember(self, update_id: int):
+        if self._shared:
+            try:
+                self._redis.set(self.key(update_id), 1, ex = self._ttl, nx = True)
+            except RedisError:
+                logger.exception('cannot remember update %s', update_id)
+                self._count('errors')
+            return
+
+        with self._lock:
+            if update_id in self._ring_ids:
+                return
+            if len(self._ring) == self._ring.maxlen:
+                self._ring_ids.discard(self._ring[0]) #deque сам вытолкнет самый старый id при append
+            self._ring.append(update_id)
+            self._ring_ids.add(update_id)
+
+    @property
+    def metrics(self) -> dict:
+        """
+            сколько обновлений проверено, сколько из них оказались повторами и их доля в процентах
+        """
+        with self._lock:
+            rez = dict(self._counters)
+        rez['rate'] = round(100 * rez['duplicates'] / rez['checked'], 2) if rez['checked'] else 0
+        return rez
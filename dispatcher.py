@@ -0,0 +1,126 @@
+"""
+    Обработка входящих обновлений Telegram в фоновых потоках.
+
+    Обновления раскладываются по дорожкам (lanes) по id пользователя: у каждой дорожки своя очередь и свой поток,
+    поэтому обновления одного пользователя обрабатываются строго по очереди и не гоняются за его сессию,
+    а разные пользователи обрабатываются параллельно. Очереди ограничены: если дорожка переполнена,
+    submit() возвращает False и вызывающий сам решает, что делать (вебхук отвечает Telegram 429 - тот повторит доставку).
+"""
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+#поля Update, в которых может прийти обновление от пользователя
+UPDATE_KINDS = ('message', 'edited_message', 'callback_query', 'poll_answer', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'channel_post', 'edited_channel_post')
+
+
+def update_user_id(update) -> int:
+    """
+        id пользователя (или чата), от которого пришло обновление. 0 - если определить не удалось
+    """
+    for kind in UPDATE_KINDS:
+        obj = getattr(update, kind, None)
+        if obj is None:
+            continue
+
+        user = getattr(obj, 'from_user', None) or getattr(obj, 'user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(obj, 'chat', None)
+        if chat is not None:
+            return chat.id
+    return 0
+
+
+class Dispatcher():
+    """
+        handle(update, *context) вызывается в потоке дорожки, context - то, что передали в submit вместе с обновлением.
+        lanes - число потоков, queue_size - длина очереди одной дорожки
+    """
+
+    def __init__(self, handle, lanes: int = 4, queue_size: int = 100, name: str = 'updates'):
+        self._handle = handle
+        self._queues = [queue.Queue(maxsize = queue_size) for _ in range(lanes)]
+        self._lock = threading.Lock()
+        self._counters = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+        self._max_depth = 0
+
+        self._workers = [threading.Thread(target = self._work, args = (q,), name = '{}-{}'.format(name, n), daemon = True)
+            for n, q in enumerate(self._queues)]
+        for worker in self._workers:
+            worker.start()
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def lane(self, user_id: int) -> int:
+        return user_id % len(self._queues)
+
+    def submit(self, update, *context, block: bool = False) -> bool:
+        """
+            ставит обновление в очередь дорожки его пользователя. Если очередь полна: при block=False
+            обновление не принимается и возвращается False, при block=True - ждём, пока место освободится
+        """
+        lane = self._queues[self.lane(update_user_id(update))]
+        try:
+            lane.put((update, context), block = block)
+        except queue.Full:
+            self._count('rejected')
+            return False
+
+        depth = lane.qsize()
+        with self._lock:
+            self._counters['accepted'] += 1
+            self._max_depth = max(self._max_depth, depth)
+        return True
+
+    def _work(self, lane: queue.Queue):
+        while True:
+            item = lane.get()
+            if item is None: #close()
+                lane.task_done()
+                return
+
+            try:
+                update, context = item
+                self._handle(update, *context)
+                self._count('processed')
+            except Exception:
+                self._count('failed')
+                logger.exception('update processing failed')
+            finally:
+                lane.task_done()
+
+    def join(self):
+        """
+            ждёт, пока будут обработаны все принятые обновления
+        """
+        for lane in self._queues:
+            lane.join()
+
+    def close(self):
+        """
+            обрабатывает уже принятые обновления и останавливает потоки
+        """
+        for lane in self._queues:
+            lane.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    @property
+    def metrics(self) -> dict:
+        """
+            глубина очереди каждой дорожки, максимальная глубина с момента запуска и счётчики обновлений
+        """
+        depths = [lane.qsize() for lane in self._queues]
+        with self._lock:
+            rez = dict(self._counters)
+            rez['max_depth'] = self._max_depth
+        rez['depths'] = depths
+        rez['queued'] = sum(depths)
+        return rez
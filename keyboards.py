@@ -0,0 +1,48 @@
+"""
+    Готовые клавиатуры меню.
+
+    Клавиатура собирается и сериализуется в JSON один раз, дальше в send_message передаётся готовая строка:
+    telebot отправляет строку как есть и не собирает ReplyKeyboardMarkup заново на каждое сообщение.
+    Кэш привязан к срезу контента - после перезагрузки контента все клавиатуры собираются заново.
+    Если клавиатура зависит от чего-то ещё (например, от списка опросов в статистике), это должно входить в ключ.
+"""
+
+from telebot import types
+
+from cache import SnapshotMemo
+
+
+def reply_keyboard(rows) -> str:
+    """
+        ReplyKeyboardMarkup из списка рядов кнопок - сразу в виде JSON
+    """
+    kbd = types.ReplyKeyboardMarkup(True, True)
+    for row in rows:
+        kbd.row(*row)
+    return kbd.to_json()
+
+
+def pairs(buttons) -> list:
+    """
+        кнопки по две в ряд, последняя может остаться одна
+    """
+    buttons = list(buttons)
+    return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
+
+class KeyboardCache():
+
+    def __init__(self):
+        self._markups = SnapshotMemo(lambda snapshot: {}) #клавиатуры текущего среза по ключу
+
+    def get(self, snapshot, key, build) -> str:
+        """
+            клавиатура key для среза snapshot. build() вызывается, только если такой клавиатуры ещё нет,
+            и должен вернуть JSON (см. reply_keyboard)
+        """
+        markups = self._markups.get(snapshot)
+        markup = markups.get(key)
+        if markup is None:
+            markup = build()
+            markups[key] = markup
+        return markup
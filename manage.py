@@ -0,0 +1,118 @@
+"""
+    Служебные команды для обслуживания бота. Запуск:
+
+        python manage.py <команда>
+
+    Команды:
+        migrate-counters   - перенести счётчики статистики из старой раскладки ключей в хэши
+        reconcile-totals   - пересчитать общий итог и итоги по опросам из счётчиков ответов
+        export-stats       - выгрузить счётчики всех опросов с текстами вопросов и ответов в CSV или JSONL
+        build-content-cache - заново разобрать все датасеты и собрать кэш контента для быстрого старта бота
+        lint-content       - проверить разметку MarkdownV2 и ограничения Telegram во всех датасетах и emergency.conf
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+import content
+from db import Statistics
+
+
+def migrate_counters(args):
+    moved = Statistics().migrate_legacy_counters()
+    print('перенесено ключей: {}'.format(moved))
+
+
+def reconcile_totals(args):
+    total = Statistics().reconcile_totals()
+    print('всего ответов: {}'.format(total))
+
+
+EXPORT_FIELDS = ['poll', 'question_number', 'question', 'answer_number', 'answer', 'count']
+
+
+def _poll_texts(poll_name: str, question_n: int, answer_n: int):
+    """
+        текст вопроса и ответа по номерам из статистики. Если опроса или вопроса уже нет - пустые строки
+    """
+    poll = content.current().poll_datasets.get(poll_name)
+    if poll is None or question_n >= len(poll):
+        return '', ''
+
+    question = poll[question_n]
+    return question.text, question.answer(answer_n) or ''
+
+
+def export_stats(args):
+    """
+        счётчики читаются порциями и пишутся в файл сразу, поэтому память не зависит от объёма статистики
+    """
+    content.load_content()
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(out, fieldnames = EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            write = lambda row: out.write(json.dumps(row, ensure_ascii = False) + '\n')
+
+        for poll_name, question_n, answer_n, cnt in Statistics().iter_counters(chunk_size = args.batch_size):
+            question, answer = _poll_texts(poll_name, question_n, answer_n)
+            write({'poll': poll_name, 'question_number': question_n, 'question': question,
+                'answer_number': answer_n, 'answer': answer, 'count': cnt})
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def build_content_cache(args):
+    if os.path.exists(args.output):
+        os.remove(args.output) #собираем с нуля, а не дополняем старый кэш
+    snapshot = content.load_content(cache_path = args.output)
+    print('датасетов в кэше: {}'.format(len(snapshot.reparsed)))
+
+
+def lint_content(args):
+    """
+        выводит все строки контента, которые бот не сможет отправить как есть. Код возврата 1, если такие есть -
+        удобно для проверки перед деплоем
+    """
+    snapshot = content.load_content()
+    for source, row, error in snapshot.problems:
+        print('{}: {}: {}'.format(source, row, error))
+
+    print('ошибок: {}'.format(len(snapshot.problems)))
+    if snapshot.problems:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Служебные команды бота')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    commands.add_parser('migrate-counters', help = 'перенести счётчики статистики в хэши').set_defaults(func = migrate_counters)
+    commands.add_parser('reconcile-totals', help = 'пересчитать итоги по счётчикам').set_defaults(func = reconcile_totals)
+
+    export = commands.add_parser('export-stats', help = 'выгрузить статистику в CSV или JSONL')
+    export.add_argument('--format', choices = ['csv', 'jsonl'], default = 'csv')
+    export.add_argument('--output', default = '-', help = 'файл для выгрузки, по умолчанию - stdout')
+    export.add_argument('--batch-size', type = int, default = 500, help = 'сколько счётчиков читать за одно обращение к базе')
+    export.set_defaults(func = export_stats)
+
+    build = commands.add_parser('build-content-cache', help = 'собрать кэш скомпилированных датасетов')
+    build.add_argument('--output', default = content.CONTENT_CACHE)
+    build.set_defaults(func = build_content_cache)
+
+    commands.add_parser('lint-content', help = 'проверить разметку и длины текстов в контенте').set_defaults(func = lint_content)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
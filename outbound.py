@@ -0,0 +1,367 @@
+"""
+    Исходящие запросы к Telegram API: общий пул соединений и ограничение скорости отправки.
+
+    Telegram ограничивает бота примерно 30 сообщениями в секунду в сумме и примерно одним сообщением в секунду
+    в одном чате (короткие всплески допустимы). Превышение оборачивается ошибкой 429 с retry_after.
+    Здесь перед каждым отправляющим методом берётся токен из общего ведра и из ведра чата (token bucket):
+    если токенов нет, отправляющий поток ждёт. Ответ 429 не теряет сообщение - ждём retry_after и повторяем.
+    Пока сообщение в чат ждёт (ведра или retry_after), следующие сообщения в тот же чат стоят за ним,
+    поэтому порядок сообщений в чате сохраняется.
+
+    Всё подключается к telebot одной функцией install() - код обработчиков не меняется.
+
+    Вебхук может ответить на обновление одним вызовом API прямо в теле HTTP-ответа - это экономит целый запрос к API.
+    Пока поток обрабатывает обновление внутри inline_reply(reply), первый подходящий вызов не отправляется,
+    а отдаётся в reply.offer(). Ответ на коллбэк отдаётся сразу: его порядок относительно сообщений не важен.
+    Отправка сообщения придерживается до конца обработки: если за ним последуют другие вызовы, оно уходит обычным
+    запросом раньше них (иначе Telegram мог бы выполнить его после следующих сообщений), и только если
+    вызов был единственным - отдаётся в ответ вебхуку. Ошибку вызова из ответа вебхука Telegram не сообщает,
+    поэтому отправка отдаётся туда, только если ограничитель даёт токены прямо сейчас - иначе она идёт обычным
+    запросом и ждёт своей очереди.
+
+    Внутри deferred_calls() отправляющие вызовы не выполняются, а копятся до flush() - так обработчик
+    отправляет сообщения только после того, как его изменения сессии записаны в базу.
+"""
+
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+#методы, которые отправляют сообщение в чат и попадают под ограничения Telegram
+SENDING_METHODS = frozenset(('sendMessage', 'sendPoll', 'sendPhoto', 'sendAnimation', 'sendDocument', 'sendVideo',
+    'sendAudio', 'sendVoice', 'sendSticker', 'sendLocation', 'sendContact', 'sendDice', 'sendMediaGroup',
+    'forwardMessage', 'copyMessage'))
+
+
+#методы, которые можно отдать в ответе вебхука. Результат такого вызова неизвестен, обработчик получит None
+INLINE_METHODS = frozenset(('answerCallbackQuery', 'sendMessage', 'sendPoll', 'sendChatAction'))
+
+#методы, порядок которых относительно остальных вызовов не важен - такие отдаются в ответ вебхука сразу
+ORDER_FREE_METHODS = frozenset(('answerCallbackQuery', 'sendChatAction'))
+
+#параметры, которые telebot передаёт строкой с JSON - в теле ответа вебхука им место как объектам
+JSON_PARAMS = ('reply_markup', 'options', 'entities', 'caption_entities', 'explanation_entities')
+
+#методы, которые можно отложить в deferred_calls(): их результат обработчикам не нужен
+DEFERRABLE_METHODS = SENDING_METHODS | INLINE_METHODS
+
+_local = threading.local()
+
+_limiter = None #ограничитель из install(): через него резервируются токены для вызовов в ответе вебхука
+
+
+class _InlineSlot():
+    __slots__ = ('reply', 'pending', 'used')
+
+    def __init__(self, reply):
+        self.reply = reply      #reply.offer(payload) -> bool: False, если HTTP-ответ уже ушёл
+        self.pending = None     #придержанный вызов: (make_request, аргументы)
+        self.used = False       #первый вызов уже был - остальные идут обычными запросами
+
+
+def inline_payload(method_name: str, params: dict) -> dict:
+    payload = {'method': method_name}
+    for key, val in (params or {}).items():
+        if key == 'connect-timeout':
+            continue
+        if key in JSON_PARAMS and isinstance(val, str):
+            val = json.loads(val)
+        payload[key] = val
+    return payload
+
+
+class inline_reply():
+    """
+        обработка обновления, на которое можно ответить в теле ответа вебхука. reply=None - обычный режим
+    """
+
+    def __init__(self, reply):
+        self._slot = _InlineSlot(reply) if reply is not None else None
+
+    def __enter__(self):
+        _local.slot = self._slot
+        return self
+
+    def __exit__(self, *exc):
+        slot, _local.slot = self._slot, None
+        if slot is None:
+            return
+
+        #единственный вызов за всю обработку - отдаём его в ответ вебхука, если ещё не поздно
+        pending, slot.pending = slot.pending, None
+        if pending is not None:
+            make_request, args = pending
+            if not _offer(slot, args[1], args[3]):
+                make_request(*args)
+        else:
+            slot.reply.offer(None) #отдавать нечего - закрываем HTTP-ответ пустым (если он ещё не ушёл)
+
+
+class deferred_calls():
+    """
+        отправляющие вызовы API внутри блока копятся и уходят по порядку в flush(). Если flush() так и не вызван
+        (например, транзакция сессии не записалась), накопленные вызовы отбрасываются. Отложенный вызов возвращает None
+    """
+
+    def __init__(self):
+        self._calls = []
+
+    def __enter__(self):
+        _local.deferred = self._calls
+        return self
+
+    def __exit__(self, *exc):
+        _local.deferred = None
+
+    def flush(self):
+        calls, self._calls = self._calls, []
+        _local.deferred = None #дальше в этом блоке вызовы уходят сразу
+        for make_request, args in calls:
+            _send(make_request, *args)
+
+
+def _offer(slot: _InlineSlot, method_name: str, params: dict) -> bool:
+    """
+        отдаёт вызов в ответ вебхука, если ограничитель пропускает его без ожидания.
+        Если ответ уже ушёл, токены возвращаются - вызов уйдёт обычным запросом и возьмёт их сам
+    """
+    if _limiter is not None and not _limiter.reserve(method_name, params):
+        return False
+    if slot.reply.offer(inline_payload(method_name, params)):
+        return True
+    if _limiter is not None:
+        _limiter.refund(method_name, params)
+    return False
+
+
+def _send(make_request, token, method_name, method = 'get', params = None, files = None):
+    """
+        make_request с учётом ответа вебхука (см. inline_reply). make_request - уже с ограничением скорости:
+        придержанный вызов, когда бы он ни ушёл, сам берёт токен своего чата и сам повторяется после 429
+    """
+    deferred = getattr(_local, 'deferred', None)
+    if deferred is not None and method_name in DEFERRABLE_METHODS:
+        deferred.append((make_request, (token, method_name, method, params, files)))
+        return None
+
+    slot = getattr(_local, 'slot', None)
+    if slot is None:
+        return make_request(token, method_name, method, params, files)
+
+    if slot.pending is not None:
+        #следующий вызов: придержанный должен уйти раньше него
+        (pending_request, args), slot.pending = slot.pending, None
+        pending_request(*args)
+
+    if not slot.used and files is None and method_name in INLINE_METHODS:
+        slot.used = True
+        if method_name not in ORDER_FREE_METHODS:
+            slot.pending = (make_request, (token, method_name, method, params, files))
+            return None
+        if _offer(slot, method_name, params):
+            return None
+
+    slot.used = True
+    return make_request(token, method_name, method, params, files)
+
+
+class TokenBucket():
+    """
+        rate токенов в секунду, не больше burst про запас. take() резервирует токен и возвращает,
+        сколько секунд нужно подождать, прежде чем им воспользоваться
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1 #может уйти в минус: это очередь уже зарезервированных отправок
+
+            wait = 0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._blocked_until - now)
+
+    def try_take(self) -> bool:
+        """
+            берёт токен, только если его не нужно ждать. False - токен не взят
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1 or now < self._blocked_until:
+                return False
+            self._tokens -= 1
+            return True
+
+    def refund(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def block(self, seconds: float):
+        """
+            Telegram попросил подождать (retry_after)
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class _Chat():
+    __slots__ = ('bucket', 'lock')
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.lock = threading.Lock() #отправки в один чат идут по одной
+
+
+class OutboundLimiter():
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 3,
+            chats_cache_size: int = 10000):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = LRUCache(maxsize = chats_cache_size, ttl = 3600)
+        self._max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._counters = {'sent': 0, 'inline': 0, 'throttled': 0, 'rate_limited': 0, 'failed': 0, 'waiting': 0}
+        self._waited = 0.0
+
+    def _count(self, counter: str, delta: int = 1):
+        with self._lock:
+            self._counters[counter] += delta
+
+    def _wait(self, *buckets):
+        delay = max(bucket.take() for bucket in buckets)
+        if delay > 0:
+            with self._lock:
+                self._counters['throttled'] += 1
+                self._waited += delay
+            time.sleep(delay)
+
+    def call(self, make_request, token, method_name, method = 'get', params = None, files = None):
+        """
+            обёртка над apihelper._make_request. Методы, не отправляющие сообщений, проходят без ограничений
+        """
+        if method_name not in SENDING_METHODS:
+            return make_request(token, method_name, method, params, files)
+
+        chat_id = (params or {}).get('chat_id')
+        chat = self._chats.get_or_create(chat_id, lambda: _Chat(self._chat_rate, self._chat_burst))
+
+        self._count('waiting')
+        try:
+            with chat.lock:
+                for attempt in range(self._max_retries + 1):
+                    self._wait(chat.bucket, self._global)
+                    try:
+                        rez = make_request(token, method_name, method, params, files)
+                        self._count('sent')
+                        return rez
+
+                    except apihelper.ApiTelegramException as e:
+                        retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+                        if e.error_code != 429 or retry_after is None or attempt == self._max_retries:
+                            self._count('failed')
+                            raise
+
+                        self._count('rate_limited')
+                        logger.warning('%s to chat %s rate limited, retry after %s s', method_name, chat_id, retry_after)
+                        chat.bucket.block(retry_after)
+        finally:
+            self._count('waiting', -1)
+
+    def reserve(self, method_name: str, params: dict) -> bool:
+        """
+            токены для вызова, который уйдёт в ответе вебхука. True - только если ждать не нужно: в чате никто
+            не отправляет, токены чата и общий есть, Telegram не просил подождать. Иначе ничего не берётся
+        """
+        if method_name not in SENDING_METHODS:
+            return True
+
+        chat = self._chats.get_or_create((params or {}).get('chat_id'), lambda: _Chat(self._chat_rate, self._chat_burst))
+        if not chat.lock.acquire(blocking = False):
+            return False
+        try:
+            if not chat.bucket.try_take():
+                return False
+            if not self._global.try_take():
+                chat.bucket.refund()
+                return False
+        finally:
+            chat.lock.release()
+
+        with self._lock:
+            self._counters['sent'] += 1
+            self._counters['inline'] += 1
+        return True
+
+    def refund(self, method_name: str, params: dict):
+        """
+            возвращает токены, взятые reserve(), если вызов так и не ушёл в ответе вебхука
+        """
+        if method_name not in SENDING_METHODS:
+            return
+
+        chat = self._chats.get_or_create((params or {}).get('chat_id'), lambda: _Chat(self._chat_rate, self._chat_burst))
+        chat.bucket.refund()
+        self._global.refund()
+        with self._lock:
+            self._counters['sent'] -= 1
+            self._counters['inline'] -= 1
+
+    @property
+    def metrics(self) -> dict:
+        """
+            waiting - сколько отправок сейчас ждут своей очереди, throttled - сколько ждали токена,
+            rate_limited - сколько раз Telegram всё же ответил 429, inline - сколько отправок ушло в ответе вебхука
+        """
+        with self._lock:
+            rez = dict(self._counters)
+            rez['waited_seconds'] = round(self._waited, 1)
+        rez['chats'] = len(self._chats)
+        return rez
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """
+        одна сессия requests на все потоки: соединения с api.telegram.org держатся открытыми (keep-alive)
+        и переиспользуются, пул не меньше числа потоков, которые одновременно отправляют запросы
+    """
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size))
+    return session
+
+
+def install(limiter: OutboundLimiter, pool_size: int = 16):
+    """
+        подключает пул соединений и ограничение скорости ко всем запросам telebot
+    """
+    global _limiter
+    _limiter = limiter
+
+    make_request = apihelper._make_request
+    limited = lambda token, method_name, method = 'get', params = None, files = None: \
+        limiter.call(make_request, token, method_name, method, params, files)
+
+    apihelper.session = pooled_session(pool_size)
+    apihelper._make_request = lambda token, method_name, method = 'get', params = None, files = None: \
+        _send(limited, token, method_name, method, params, files)
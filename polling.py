@@ -0,0 +1,95 @@
+"""
+    Приём обновлений long polling'ом (getUpdates), когда вебхук не используется.
+
+    Обновления забираются пачками и раздаются в dispatcher: обновления одного пользователя обрабатываются
+    по порядку в одной дорожке, разные пользователи - параллельно, как и в режиме вебхука.
+    Следующий offset (а им Telegram подтверждает получение всех обновлений до него) передаётся только
+    после того, как пачка обработана целиком. Если процесс упадёт посреди пачки, после перезапуска Telegram
+    отдаст её снова; уже обработанные обновления из неё отбросит dedup.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 100 #больше getUpdates за раз не отдаёт
+
+MAX_BACKOFF = 30 #пауза после ошибки getUpdates растёт вдвое, но не дольше стольких секунд
+
+
+class LongPoller():
+    """
+        get_updates(offset, limit, long_polling_timeout) - bot.get_updates, dispatcher - dispatcher.Dispatcher
+    """
+
+    def __init__(self, get_updates, dispatcher, batch_size: int = 100, timeout: int = 20):
+        self._get_updates = get_updates
+        self._dispatcher = dispatcher
+        self._batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self._timeout = timeout
+        self.offset = None #update_id, с которого начнётся следующая пачка; None - с первого неподтверждённого
+        self._submitted = None #update_id последнего обновления текущей пачки, отданного в dispatcher
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {'batches': 0, 'updates': 0, 'errors': 0, 'last_batch': 0}
+
+    def _fetch(self, offset, limit: int, timeout: int) -> list:
+        return self._get_updates(offset = offset, limit = limit, long_polling_timeout = timeout)
+
+    def run(self):
+        """
+            забирает и обрабатывает пачки, пока не вызван stop()
+        """
+        logger.info('long polling started, batch %s, timeout %s s', self._batch_size, self._timeout)
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                updates = self._fetch(self.offset, self._batch_size, self._timeout)
+                failures = 0
+            except Exception:
+                logger.exception('getUpdates failed')
+                with self._lock:
+                    self._counters['errors'] += 1
+                self._stopped.wait(min(2 ** failures, MAX_BACKOFF))
+                failures += 1
+                continue
+
+            if not updates:
+                continue
+
+            for update in updates:
+                self._dispatcher.submit(update, block = True)
+                self._submitted = max(update.update_id, self._submitted or 0)
+            self._dispatcher.join() #пачка обработана целиком - только теперь её можно подтвердить
+            self.offset = self._submitted + 1
+
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['updates'] += len(updates)
+                self._counters['last_batch'] = len(updates)
+
+    def stop(self):
+        self._stopped.set()
+
+    def commit(self):
+        """
+            подтверждает обработанные пачки сразу, не дожидаясь следующего getUpdates (при остановке).
+            Вызывается после dispatcher.close(): раз все принятые обновления уже обработаны,
+            подтверждается и прерванная пачка - до последнего обновления, отданного в dispatcher
+        """
+        if self._submitted is not None:
+            self.offset = self._submitted + 1
+        if self.offset is None:
+            return
+        try:
+            self._fetch(self.offset, 1, 0)
+        except Exception:
+            logger.exception('cannot commit offset %s', self.offset)
+
+    @property
+    def metrics(self) -> dict:
+        with self._lock:
+            rez = dict(self._counters)
+        rez['offset'] = self.offset
+        return rez
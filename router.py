@@ -0,0 +1,92 @@
+"""
+    Маршрутизация текстовых сообщений по точному совпадению текста.
+
+    pyTelegramBotAPI перебирает обработчики по порядку регистрации и для каждого вычисляет func=, поэтому каждое
+    сообщение платит за все меню и опросы, прежде чем дойти до заглушки. Здесь все тексты кнопок собраны в один словарь:
+    поиск обработчика - одно обращение к dict, сколько бы ни было меню и опросов.
+
+    Таблица строится для конкретного среза контента и пересобирается, когда приходит сообщение с другим срезом
+    (то есть после перезагрузки контента). Если один и тот же текст зарегистрирован несколько раз, выигрывает
+    маршрут, зарегистрированный раньше - как и у обработчиков telebot.
+"""
+
+from cache import SnapshotMemo
+
+
+class Route():
+    __slots__ = ('handler', 'admin')
+
+    def __init__(self, handler, admin: bool):
+        self.handler = handler
+        self.admin = admin #обработчик только для админов: остальным отвечает fallback
+
+
+class Router():
+    """
+        route(*texts) - обработчик для фиксированных текстов,
+        route_content(keys) - для текстов из контента: keys(snapshot) возвращает тексты для данного среза,
+        route_prefix(prefix) - для текстов вида 'prefix значение', prefix должен заканчиваться на PREFIX_END,
+        fallback - обработчик для всего остального (и для не-админов, попавших на админский маршрут)
+    """
+
+    PREFIX_END = ':'
+
+    def __init__(self, is_admin):
+        self.is_admin = is_admin #is_admin(message) -> bool
+        self.fallback = None
+
+        self._routes = [] #(тексты или функция от среза, Route) - в порядке регистрации
+        self._prefixes = {}
+        self._tables = SnapshotMemo(self.build)
+
+    def route(self, *texts, admin: bool = False):
+        def decorator(handler):
+            self._routes.append((texts, Route(handler, admin)))
+            self._tables.clear()
+            return handler
+        return decorator
+
+    def route_content(self, keys, admin: bool = False):
+        def decorator(handler):
+            self._routes.append((keys, Route(handler, admin)))
+            self._tables.clear()
+            return handler
+        return decorator
+
+    def route_prefix(self, prefix: str, admin: bool = False):
+        if not prefix.endswith(self.PREFIX_END):
+            raise ValueError('prefix must end with {!r}'.format(self.PREFIX_END))
+
+        def decorator(handler):
+            self._prefixes.setdefault(prefix, Route(handler, admin))
+            return handler
+        return decorator
+
+    def otherwise(self, handler):
+        self.fallback = handler
+        return handler
+
+    def build(self, snapshot) -> dict:
+        """
+            таблица текст -> Route для среза snapshot
+        """
+        table = {}
+        for texts, route in self._routes:
+            for text in (texts(snapshot) if callable(texts) else texts):
+                table.setdefault(text, route)
+        return table
+
+    def table(self, snapshot) -> dict:
+        return self._tables.get(snapshot)
+
+    def resolve(self, text: str, snapshot):
+        route = self.table(snapshot).get(text)
+        if route is None and self.PREFIX_END in text:
+            route = self._prefixes.get(text[:text.index(self.PREFIX_END) + 1])
+        return route
+
+    def dispatch(self, message, snapshot):
+        route = self.resolve(message.text or '', snapshot)
+        if route is None or (route.admin and not self.is_admin(message)):
+            return self.fallback(message)
+        return route.handler(message)
@@ -0,0 +1,441 @@
+"""
+    Хранилища для сессий и статистики.
+
+    Session и Statistics работают с подмножеством команд Redis (строки, хэши, списки, пайплайны с WATCH/MULTI/EXEC),
+    поэтому хранилище - это всё, что умеет эти команды:
+     - RedisBackend - настоящий Redis по REDIS_URL. Подключение создаётся при первом обращении, а не при импорте
+     - MemoryBackend - хранилище в памяти процесса со сроками жизни ключей. Для деплоя в один инстанс и для тестов
+
+    Какое хранилище использовать, задаётся в config.STORAGE_BACKEND
+"""
+
+import fnmatch
+import heapq
+import threading
+import time
+
+try:
+    from redis import RedisError, WatchError, ResponseError
+except ImportError: #для хранилища в памяти сам пакет redis не обязателен
+    class RedisError(Exception):
+        pass
+
+    class WatchError(RedisError):
+        pass
+
+    class ResponseError(RedisError):
+        pass
+
+
+class RedisBackend():
+    """
+        Redis по URL. Клиент создаётся лениво и дальше переиспользуется (внутри у него пул соединений)
+    """
+
+    def __init__(self, url: str):
+        self._url = url
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import redis
+                    self._client = redis.StrictRedis.from_url(self._url, decode_responses =True )
+        return self._client
+
+
+class MemoryBackend():
+    """
+        Хранилище в памяти процесса. Данные живут, пока жив процесс
+    """
+
+    def __init__(self):
+        self.client = MemoryStore()
+
+
+class MemoryStore():
+    """
+        Redis-подобное хранилище в памяти: те же имена и сигнатуры команд, что у redis.StrictRedis(decode_responses=True),
+        но только для команд, которые нужны боту.
+
+        Все команды выполняются под одной блокировкой, поэтому пайплайн исполняется атомарно, как MULTI/EXEC.
+        Просроченные ключи удаляются и при обращении к ним, и фоново при любой команде (по очереди сроков в куче)
+    """
+
+    def __init__(self):
+        self._data = {}      # ключ -> str | dict | list
+        self._expires = {}   # ключ -> момент (time.monotonic), когда ключ протухнет
+        self._deadlines = [] # куча (момент, ключ) для активного удаления протухших ключей
+        self._versions = {}  # ключ -> номер изменения, только пока ключ кто-то отслеживает (WATCH)
+        self._watchers = {}  # ключ -> сколько пайплайнов его отслеживают
+        self._change = 0
+        self._lock = threading.RLock()
+
+    # --- служебное ---
+
+    def _expire_due(self):
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self._deadlines)
+            if self._expires.get(key) == deadline:
+                self._drop(key)
+
+    def _alive(self, key: str) -> bool:
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._drop(key)
+        return key in self._data
+
+    def _drop(self, key: str):
+        if key in self._data:
+            del self._data[key]
+            self._touch(key)
+        self._expires.pop(key, None)
+
+    def _touch(self, key: str):
+        #номер изменения нужен только отслеживаемым ключам - иначе словарь рос бы с каждым когда-либо записанным ключом
+        if key in self._versions:
+            self._change += 1
+            self._versions[key] = self._change
+
+    def _version(self, key: str) -> int:
+        self._alive(key)
+        return self._versions.get(key, 0)
+
+    def _watch(self, key: str) -> int:
+        self._alive(key)
+        self._watchers[key] = self._watchers.get(key, 0) + 1
+        return self._versions.setdefault(key, self._change)
+
+    def _unwatch(self, key: str):
+        left = self._watchers.pop(key, 1) - 1
+        if left > 0:
+            self._watchers[key] = left
+        else:
+            self._versions.pop(key, None)
+
+    def _get_typed(self, key: str, kind: type, create: bool = False):
+        self._expire_due()
+        if not self._alive(key):
+            if not create:
+                return None
+            self._data[key] = kind()
+        value = self._data[key]
+        if not isinstance(value, kind):
+            raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    @staticmethod
+    def _str(value) -> str:
+        return value if isinstance(value, str) else str(value)
+
+    # --- ключи ---
+
+    def exists(self, *names) -> int:
+        with self._lock:
+            self._expire_due()
+            return sum(1 for name in names if self._alive(name))
+
+    def delete(self, *names) -> int:
+        with self._lock:
+            self._expire_due()
+            deleted = 0
+            for name in names:
+                if self._alive(name):
+                    self._drop(name)
+                    deleted += 1
+            return deleted
+
+    unlink = delete
+
+    def expire(self, name: str, time_: int) -> bool:
+        with self._lock:
+            self._expire_due()
+            if not self._alive(name):
+                return False
+            deadline = time.monotonic() + time_
+            self._expires[name] = deadline
+            heapq.heappush(self._deadlines, (deadline, name))
+            if len(self._deadlines) > 2 * len(self._expires) + 16:
+                #в куче копятся устаревшие сроки продлённых ключей - пересобираем её из актуальных
+                self._deadlines = [(deadline, key) for key, deadline in self._expires.items()]
+                heapq.heapify(self._deadlines)
+            self._touch(name)
+            return True
+
+    def ttl(self, name: str) -> int:
+        with self._lock:
+            if not self._alive(name):
+                return -2
+            deadline = self._expires.get(name)
+            if deadline is None:
+                return -1
+            return max(0, round(deadline - time.monotonic()))
+
+    def scan(self, cursor: int = 0, match: str = None, count: int = None, _type: str = None):
+        with self._lock:
+            self._expire_due()
+            keys = sorted(self._data.keys())
+            count = count or 10
+            batch = keys[cursor:cursor + count]
+            next_cursor = cursor + count if cursor + count < len(keys) else 0
+            return next_cursor, [key for key in batch if self._match(key, match, _type)]
+
+    def scan_iter(self, match: str = None, count: int = None, _type: str = None):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor = cursor or 0, match = match, count = count, _type = _type)
+            for key in keys:
+                yield key
+
+    def keys(self, pattern: str = '*') -> list:
+        with self._lock:
+            self._expire_due()
+            return [key for key in self._data.keys() if self._match(key, pattern, None)]
+
+    def _match(self, key: str, match: str, _type: str) -> bool:
+        if match is not None and not fnmatch.fnmatchcase(key, match):
+            return False
+        if _type is not None:
+            kinds = {'STRING': (str, set), 'HASH': dict, 'LIST': list} #HyperLogLog в Redis - тоже строка
+            return isinstance(self._data[key], kinds[_type.upper()])
+        return True
+
+    def flushdb(self):
+        with self._lock:
+            for key in list(self._data.keys()):
+                self._drop(key)
+
+    # --- строки ---
+
+    def get(self, name: str):
+        with self._lock:
+            return self._get_typed(name, str)
+
+    def mget(self, keys, *args) -> list:
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        with self._lock:
+            self._expire_due()
+            return [self._data[key] if self._alive(key) and isinstance(self._data[key], str) else None
+                for key in keys + list(args)]
+
+    def set(self, name: str, value, ex: int = None, nx: bool = False):
+        with self._lock:
+            self._expire_due()
+            if nx and self._alive(name):
+                return None
+            self._data[name] = self._str(value)
+            self._expires.pop(name, None)
+            self._touch(name)
+            if ex is not None:
+                self.expire(name, ex)
+            return True
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        with self._lock:
+            value = int(self._get_typed(name, str) or 0) + amount
+            self._data[name] = str(value)
+            self._touch(name)
+            return value
+
+    incrby = incr
+
+    # --- хэши ---
+
+    def hget(self, name: str, key: str):
+        with self._lock:
+            h = self._get_typed(name, dict)
+            return h.get(key) if h is not None else None
+
+    def hmget(self, name: str, keys, *args) -> list:
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        with self._lock:
+            h = self._get_typed(name, dict) or {}
+            return [h.get(key) for key in keys + list(args)]
+
+    def hgetall(self, name: str) -> dict:
+        with self._lock:
+            h = self._get_typed(name, dict)
+            return dict(h) if h is not None else {}
+
+    def hset(self, name: str, key: str = None, value = None, mapping: dict = None) -> int:
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        if not items:
+            raise ResponseError("'hset' with no key value pairs")
+
+        with self._lock:
+            h = self._get_typed(name, dict, create = True)
+            added = sum(1 for k in items if k not in h)
+            h.update({k: self._str(v) for k, v in items.items()})
+            self._touch(name)
+            return added
+
+    def hsetnx(self, name: str, key: str, value) -> bool:
+        with self._lock:
+            h = self._get_typed(name, dict, create = True)
+            if key in h:
+                return False
+            h[key] = self._str(value)
+            self._touch(name)
+            return True
+
+    def hincrby(self, name: str, key: str, amount: int = 1) -> int:
+        with self._lock:
+            h = self._get_typed(name, dict, create = True)
+            value = int(h.get(key, 0)) + amount
+            h[key] = str(value)
+            self._touch(name)
+            return value
+
+    def hdel(self, name: str, *keys) -> int:
+        with self._lock:
+            h = self._get_typed(name, dict)
+            if h is None:
+                return 0
+            deleted = sum(1 for k in keys if h.pop(k, None) is not None)
+            if not h:
+                self._drop(name)
+            self._touch(name)
+            return deleted
+
+    def hscan(self, name: str, cursor: int = 0, match: str = None, count: int = None):
+        with self._lock:
+            h = self._get_typed(name, dict) or {}
+            fields = sorted(h.keys())
+            count = count or 10
+            batch = fields[cursor:cursor + count]
+            next_cursor = cursor + count if cursor + count < len(fields) else 0
+            return next_cursor, {f: h[f] for f in batch if match is None or fnmatch.fnmatchcase(f, match)}
+
+    def hscan_iter(self, name: str, match: str = None, count: int = None):
+        cursor = None
+        while cursor != 0:
+            cursor, data = self.hscan(name, cursor = cursor or 0, match = match, count = count)
+            for item in data.items():
+                yield item
+
+    def hlen(self, name: str) -> int:
+        with self._lock:
+            h = self._get_typed(name, dict)
+            return len(h) if h is not None else 0
+
+    # --- списки ---
+
+    def rpush(self, name: str, *values) -> int:
+        with self._lock:
+            l = self._get_typed(name, list, create = True)
+            l.extend(self._str(v) for v in values)
+            self._touch(name)
+            return len(l)
+
+    def lrange(self, name: str, start: int, end: int) -> list:
+        with self._lock:
+            l = self._get_typed(name, list)
+            if l is None:
+                return []
+            if start < 0:
+                start = max(len(l) + start, 0)
+            if end < 0:
+                end = len(l) + end
+            return l[start:end + 1]
+
+    def llen(self, name: str) -> int:
+        with self._lock:
+            l = self._get_typed(name, list)
+            return len(l) if l is not None else 0
+
+    # --- HyperLogLog ---
+    #в памяти хранится обычное множество, поэтому подсчёт точный
+
+    def pfadd(self, name: str, *values) -> int:
+        with self._lock:
+            hll = self._get_typed(name, set, create = True)
+            before = len(hll)
+            hll.update(self._str(v) for v in values)
+            self._touch(name)
+            return 1 if len(hll) != before else 0
+
+    def pfcount(self, *sources) -> int:
+        with self._lock:
+            rez = set()
+            for name in sources:
+                rez |= self._get_typed(name, set) or set()
+            return len(rez)
+
+    # --- пайплайны ---
+
+    def pipeline(self, transaction: bool = True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline():
+    """
+        Пайплайн для MemoryStore с семантикой redis-py:
+         - команды копятся и выполняются атомарно в execute()
+         - после watch() команды выполняются сразу, пока не будет вызван multi()
+         - если отслеживаемый ключ изменился между watch() и execute(), execute() бросает WatchError
+    """
+
+    def __init__(self, store: MemoryStore):
+        self._store = store
+        self._commands = []
+        self._watched = {}
+        self._immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        self._commands = []
+        self.unwatch()
+
+    def watch(self, *names):
+        with self._store._lock:
+            for name in names:
+                if name not in self._watched:
+                    self._watched[name] = self._store._watch(name)
+        self._immediate = True
+        return True
+
+    def unwatch(self):
+        with self._store._lock:
+            for name in self._watched:
+                self._store._unwatch(name)
+        self._watched = {}
+        self._immediate = False
+        return True
+
+    def multi(self):
+        self._immediate = False
+
+    def __getattr__(self, command: str):
+        method = getattr(self._store, command)
+
+        def call(*args, **kwargs):
+            if self._immediate:
+                return method(*args, **kwargs)
+            self._commands.append((method, args, kwargs))
+            return self
+
+        return call
+
+    def __len__(self):
+        return len(self._commands)
+
+    def execute(self) -> list:
+        try:
+            with self._store._lock:
+                for name, version in self._watched.items():
+                    if self._store._version(name) != version:
+                        raise WatchError('Watched variable changed.')
+                return [method(*args, **kwargs) for method, args, kwargs in self._commands]
+        finally:
+            self.reset()
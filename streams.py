@@ -0,0 +1,331 @@
+"""
+    Разделённый режим: приём вебхуков (ingress) и обработка обновлений (worker) в разных процессах.
+
+    Ingress только проверяет запрос и дописывает тело обновления в Redis Stream. Потоков-партиций несколько:
+    обновление попадает в партицию user_id % partitions, так что все обновления одного пользователя лежат
+    в одной партиции по порядку. Воркеры читают партиции через общую группу потребителей (XREADGROUP).
+    Каждую партицию в каждый момент обрабатывает только один воркер - тот, кто держит на неё аренду (ключ с TTL),
+    поэтому порядок обновлений пользователя сохраняется при любом числе воркеров. Партиции делятся между
+    живыми воркерами поровну и перераспределяются, когда воркеры появляются или пропадают.
+
+    Обработанное обновление подтверждается (XACK). Если обработка упала, она повторяется; после max_deliveries
+    попыток обновление уходит в поток мёртвых писем UpdateStream.DEAD_LETTERS и подтверждается, чтобы
+    одно сломанное обновление не заблокировало пользователя. Если воркер умер, его аренды истекают, партиции
+    забирают другие воркеры и сначала дообрабатывают то, что умерший не успел подтвердить (XCLAIM).
+    Доставка "хотя бы один раз": обновление, на котором умер воркер, может быть обработано повторно.
+
+    Нужен настоящий Redis (STORAGE_BACKEND = 'redis'): в хранилище в памяти процесса потоков нет.
+"""
+
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+from redis.exceptions import RedisError, ResponseError, WatchError
+
+from db import Redis_connection
+from dispatcher import update_user_id
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateStream(Redis_connection):
+
+    GROUP = 'workers'
+    WORKERS = 'updates:workers' #живые воркеры: имя -> время последнего сигнала
+    DEAD_LETTERS = 'updates:dead'
+
+    def __init__(self, partitions: int = 16, maxlen: int = 100000):
+        super().__init__()
+        self.partitions = partitions
+        self.maxlen = maxlen #поток обрезается примерно до стольких записей (XADD MAXLEN ~)
+
+    @staticmethod
+    def stream(partition: int) -> str:
+        return 'updates:{}'.format(partition)
+
+    @staticmethod
+    def lease(partition: int) -> str:
+        return 'updates:{}:owner'.format(partition)
+
+    def partition(self, user_id: int) -> int:
+        return user_id % self.partitions
+
+    def publish(self, update) -> bool:
+        """
+            дописывает обновление в партицию его пользователя. update.json - исходный JSON обновления
+            (его сохраняет WebhookResource). False - Redis недоступен, пусть Telegram повторит доставку
+        """
+        try:
+            self._redis.xadd(self.stream(self.partition(update_user_id(update))),
+                {'update': json.dumps(update.json, ensure_ascii = False)}, maxlen = self.maxlen, approximate = True)
+        except RedisError:
+            logger.exception('cannot publish update %s', update.update_id)
+            return False
+        return True
+
+    def ensure_groups(self):
+        for partition in range(self.partitions):
+            try:
+                self._redis.xgroup_create(self.stream(partition), self.GROUP, id = '0', mkstream = True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e): #группа уже есть
+                    raise
+
+    def dead_letter(self, partition: int, message_id: str, body: str, error: str):
+        self._redis.xadd(self.DEAD_LETTERS, {'partition': partition, 'id': message_id, 'update': body, 'error': error},
+            maxlen = self.maxlen, approximate = True)
+
+    @property
+    def backlog(self) -> dict:
+        """
+            длина каждой партиции, число неподтверждённых обновлений в ней и число мёртвых писем
+        """
+        with self._redis.pipeline(transaction = False) as pipe:
+            for partition in range(self.partitions):
+                pipe.xlen(self.stream(partition))
+                pipe.xpending(self.stream(partition), self.GROUP)
+            pipe.xlen(self.DEAD_LETTERS)
+            rez = pipe.execute()
+
+        return {
+            'lengths': rez[0:-1:2],
+            'pending': [p['pending'] for p in rez[1:-1:2]],
+            'dead': rez[-1],
+        }
+
+
+class StreamWorker():
+    """
+        процесс-воркер: берёт в аренду свою долю партиций и обрабатывает каждую в отдельном потоке.
+        handle(body) получает JSON обновления строкой
+    """
+
+    def __init__(self, stream: UpdateStream, handle, name: str = None, lease_ttl: int = 30, max_deliveries: int = 5,
+            batch: int = 10, block_ms: int = 1000):
+        self._stream = stream
+        self._redis = stream._redis
+        self._handle = handle
+        self.name = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self._lease_ttl = lease_ttl
+        self._max_deliveries = max_deliveries
+        self._batch = batch
+        self._block_ms = block_ms
+
+        self._owned = {} #партиция -> (поток, событие остановки). Поток сам убирает партицию отсюда, когда завершится
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {'processed': 0, 'retried': 0, 'dead': 0, 'claimed': 0}
+
+    def _count(self, counter: str, delta: int = 1):
+        with self._lock:
+            self._counters[counter] += delta
+
+    @property
+    def metrics(self) -> dict:
+        with self._lock:
+            rez = dict(self._counters)
+            rez['partitions'] = sorted(self._owned)
+        return rez
+
+    def _owned_items(self) -> list:
+        with self._lock:
+            return list(self._owned.items())
+
+    #аренда партиций
+
+    def _acquire(self, partition: int) -> bool:
+        return bool(self._redis.set(self._stream.lease(partition), self.name, nx = True, ex = self._lease_ttl))
+
+    def _renew(self, partition: int, release: bool = False) -> bool:
+        """
+            продлевает (или отпускает) аренду, если она всё ещё наша
+        """
+        key = self._stream.lease(partition)
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != self.name:
+                    return False
+                pipe.multi()
+                if release:
+                    pipe.delete(key)
+                else:
+                    pipe.expire(key, self._lease_ttl)
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    def _alive_workers(self) -> int:
+        now = time.time()
+        workers = self._redis.hgetall(self._stream.WORKERS)
+        dead = [name for name, seen in workers.items() if now - float(seen) > self._lease_ttl]
+        if dead:
+            self._redis.hdel(self._stream.WORKERS, *dead)
+        return max(1, len(workers) - len(dead))
+
+    def _renew_owned(self):
+        """
+            продлевает аренды всех партиций, чьи потоки ещё работают - в том числе уже остановленных:
+            пока поток дорабатывает текущее обновление, партицию не должен забрать другой воркер
+        """
+        for partition, (_, stop) in self._owned_items():
+            if not self._renew(partition) and not stop.is_set():
+                logger.warning('lease on partition %s lost', partition)
+                stop.set()
+
+    def _rebalance(self):
+        self._redis.hset(self._stream.WORKERS, self.name, time.time())
+        self._renew_owned()
+
+        target = math.ceil(self._stream.partitions / self._alive_workers())
+        active = sorted((p for p, (_, stop) in self._owned_items() if not stop.is_set()), reverse = True)
+        for partition in active[:max(0, len(active) - target)]:
+            self._stop_partition(partition) #поток отпустит аренду, когда закончит текущее обновление
+
+        #начинаем поиск свободных партиций с разных мест, чтобы воркеры меньше сталкивались
+        start = hash(self.name) % self._stream.partitions
+        count = min(len(active), target)
+        for n in range(self._stream.partitions):
+            if count >= target:
+                break
+            partition = (start + n) % self._stream.partitions
+            if partition not in self._owned and self._acquire(partition):
+                stop = threading.Event()
+                thread = threading.Thread(target = self._consume, args = (partition, stop),
+                    name = 'partition-{}'.format(partition), daemon = True)
+                with self._lock:
+                    self._owned[partition] = (thread, stop)
+                thread.start()
+                count += 1
+
+    def _stop_partition(self, partition: int):
+        with self._lock:
+            _, stop = self._owned[partition]
+        stop.set()
+
+    def run(self):
+        """
+            основной цикл воркера: раз в треть срока аренды - сигнал "жив", продление аренд и перераспределение партиций
+        """
+        self._stream.ensure_groups()
+        logger.info('stream worker %s started', self.name)
+        while not self._stopped.is_set():
+            try:
+                self._rebalance()
+            except RedisError:
+                logger.exception('rebalance failed, will retry')
+            self._stopped.wait(self._lease_ttl / 3)
+
+    def close(self):
+        """
+            останавливает потоки партиций и ждёт, пока они доработают текущие обновления, продлевая их аренды
+        """
+        self._stopped.set()
+        for _, (_, stop) in self._owned_items():
+            stop.set()
+
+        while True:
+            owned = self._owned_items()
+            if not owned:
+                break
+            try:
+                self._renew_owned()
+            except RedisError:
+                logger.exception('cannot renew leases while stopping')
+            owned[0][1][0].join(self._lease_ttl / 3)
+        self._redis.hdel(self._stream.WORKERS, self.name)
+
+    #обработка партиции
+
+    def _consume(self, partition: int, stop: threading.Event):
+        """
+            stop проверяется перед каждым обновлением: необработанные обновления пачки остаются неподтверждёнными
+            и достанутся следующему владельцу партиции. Аренда отпускается, только когда поток действительно закончил
+        """
+        stream = self._stream.stream(partition)
+        try:
+            self._recover(partition, stop)
+            while not stop.is_set():
+                for _, messages in self._redis.xreadgroup(self._stream.GROUP, self.name, {stream: '>'},
+                        count = self._batch, block = self._block_ms) or []:
+                    for message_id, fields in messages:
+                        if stop.is_set():
+                            break
+                        self._process(partition, message_id, fields, stop)
+        except Exception:
+            logger.exception('partition %s consumer failed', partition)
+        finally:
+            with self._lock:
+                self._owned.pop(partition, None) #сначала перестаём продлевать, потом отпускаем
+            try:
+                self._renew(partition, release = True)
+            except RedisError:
+                pass #аренда истечёт сама
+
+    def _recover(self, partition: int, stop: threading.Event):
+        """
+            забирает неподтверждённые обновления партиции у прежних владельцев и обрабатывает их первыми,
+            по порядку. Раз мы держим аренду, прежний владелец эту партицию больше не обрабатывает
+        """
+        stream = self._stream.stream(partition)
+        delivered = {}
+        start = '-'
+        while True:
+            pending = self._redis.xpending_range(stream, self._stream.GROUP, start, '+', 100)
+            if not pending:
+                break
+
+            foreign = [p['message_id'] for p in pending if p['consumer'] != self.name]
+            if foreign:
+                self._redis.xclaim(stream, self._stream.GROUP, self.name, 0, foreign)
+                self._count('claimed', len(foreign))
+            for p in pending:
+                delivered[p['message_id']] = p['times_delivered']
+
+            if len(pending) < 100:
+                break
+            start = '({}'.format(pending[-1]['message_id'])
+
+        last = '0'
+        while delivered:
+            messages = self._redis.xreadgroup(self._stream.GROUP, self.name, {stream: last}, count = self._batch)
+            batch = messages[0][1] if messages else []
+            if not batch:
+                break
+            for message_id, fields in batch:
+                if stop.is_set():
+                    return
+                self._process(partition, message_id, fields, stop, delivered.get(message_id, 1))
+                last = message_id
+
+    def _process(self, partition: int, message_id: str, fields, stop: threading.Event, delivered: int = 1):
+        stream = self._stream.stream(partition)
+        if not fields: #запись уже обрезана из потока
+            self._redis.xack(stream, self._stream.GROUP, message_id)
+            return
+
+        body = fields['update']
+        error = None
+        for attempt in range(delivered, self._max_deliveries + 1):
+            try:
+                self._handle(body)
+                self._redis.xack(stream, self._stream.GROUP, message_id)
+                self._count('processed')
+                return
+            except Exception as e:
+                error = repr(e)
+                logger.exception('update %s failed (attempt %s)', message_id, attempt)
+                self._count('retried')
+                if stop.wait(min(0.1 * 2 ** attempt, 5)):
+                    return #партицию забирают - обновление останется неподтверждённым и достанется новому владельцу
+
+        #обновление так и не обработалось - в мёртвые письма, чтобы не держать остальные обновления пользователя
+        self._stream.dead_letter(partition, message_id, body, error or 'too many deliveries')
+        self._redis.xack(stream, self._stream.GROUP, message_id)
+        self._count('dead')
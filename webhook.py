@@ -0,0 +1,188 @@
+"""
+    Приём обновлений от Telegram через вебхук (Twisted).
+
+    render_POST работает в потоке реактора, поэтому всё, что можно отсечь дёшево, отсекается до разбора JSON:
+    сначала секретный токен из заголовка X-Telegram-Bot-Api-Secret-Token (сравнение за постоянное время),
+    потом адрес отправителя (сети Telegram разобраны один раз, результат проверки адреса кэшируется),
+    потом размер и форма тела. JSON разбирается только у запросов, прошедших все проверки.
+
+    В режиме inline HTTP-ответ не закрывается сразу: обработчик может вернуть в нём один вызов API
+    (см. outbound.inline_reply) - Telegram выполнит его сам, без отдельного запроса от бота.
+"""
+
+import functools
+import hmac
+import ipaddress
+import json
+import logging
+import threading
+
+import telebot
+from telebot import apihelper
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Request
+
+logger = logging.getLogger(__name__)
+
+#официальные адреса, с которых Telegram отправляет вебхуки
+TELEGRAM_NETWORKS = tuple(ipaddress.ip_network(net) for net in (
+    '149.154.160.0/20',
+    '91.108.4.0/22',
+    '2001:67c:4e8::/48',
+    '2001:b28:f23d::/48',
+    '2001:b28:f23f::/48',
+))
+
+MAX_BODY_SIZE = 256 * 1024 #обновления от Telegram намного меньше
+
+INLINE_TIMEOUT = 5 #сколько секунд держать HTTP-ответ открытым в ожидании вызова API от обработчика
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+def set_webhook(token: str, url: str, secret_token: str):
+    """
+        setWebhook с secret_token - эта версия pyTelegramBotAPI его ещё не умеет передавать
+    """
+    return apihelper._make_request(token, 'setWebhook', params = {'url': url, 'secret_token': secret_token})
+
+
+@functools.lru_cache(maxsize = 1024)
+def address_allowed(address: str, networks: tuple = TELEGRAM_NETWORKS) -> bool:
+    """
+        адрес входит в одну из сетей. Поддерживаются IPv4 и IPv6 (в том числе IPv4, записанный как ::ffff:a.b.c.d)
+    """
+    try:
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return any(ip in net for net in networks)
+
+
+def client_address(request: Request) -> str:
+    """
+        адрес отправителя. За прокси Heroku он последний в последнем заголовке x-forwarded-for,
+        без прокси - адрес TCP-соединения
+    """
+    forwarded = request.requestHeaders.getRawHeaders(b'x-forwarded-for')
+    if forwarded:
+        return forwarded[-1].rsplit(b',', 1)[-1].decode('latin-1')
+    return getattr(request.getClientAddress(), 'host', '')
+
+
+class InlineReply():
+    """
+        открытый HTTP-ответ на обновление. offer() вызывается из потока обработчика и возвращает False,
+        если ответ уже ушёл (истёк таймаут или Telegram закрыл соединение) - тогда вызов нужно отправить самому
+    """
+
+    def __init__(self, request: Request):
+        self._request = request
+        self._lock = threading.Lock()
+        self._open = True
+        self._timer = None
+        self._gone = False #соединение закрыто, писать в него нельзя
+
+    def start(self, timeout: float):
+        """
+            вызывается в потоке реактора, когда обновление принято в обработку
+        """
+        self._timer = reactor.callLater(timeout, self.offer, None)
+        self._request.notifyFinish().addErrback(self._lost)
+
+    def _lost(self, _):
+        self._gone = True
+        self._close()
+
+    def _close(self) -> bool:
+        with self._lock:
+            was_open, self._open = self._open, False
+            return was_open
+
+    def offer(self, payload) -> bool:
+        """
+            payload - вызов API в виде {'method': ..., параметры}, None - закрыть ответ пустым
+        """
+        if not self._close():
+            return False
+        reactor.callFromThread(self._finish, payload)
+        return True
+
+    def _finish(self, payload):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        if self._gone: #Telegram не дождался ответа
+            return
+
+        if payload is not None:
+            self._request.setHeader(b'content-type', b'application/json')
+            self._request.write(json.dumps(payload, ensure_ascii = False).encode())
+        self._request.finish()
+
+
+class WebhookResource(Resource):
+    """
+        submit(update) -> bool передаёт обновление на обработку; False - обработчик перегружен (ответим 429).
+        С inline=True обновление передаётся как submit(update, reply), где reply - InlineReply для outbound.inline_reply
+    """
+
+    isLeaf = True
+
+    def __init__(self, submit, secret_token: str, networks: tuple = TELEGRAM_NETWORKS, max_body_size: int = MAX_BODY_SIZE,
+            inline: bool = False, inline_timeout: float = INLINE_TIMEOUT):
+        super().__init__()
+        self._submit = submit
+        self._secret = secret_token.encode()
+        self._networks = networks
+        self._max_body_size = max_body_size
+        self._inline = inline
+        self._inline_timeout = inline_timeout
+
+    def _reject(self, request: Request, code: int) -> bytes:
+        request.setResponseCode(code)
+        return b''
+
+    def render_POST(self, request: Request):
+        if not hmac.compare_digest(request.getHeader(SECRET_HEADER) or b'', self._secret):
+            return self._reject(request, 403)
+
+        address = client_address(request)
+        if not address_allowed(address, self._networks): #кто-то прикидывается сервером ТГ, но заходит с неправильного IP
+            logger.warning('webhook request from unexpected address %s', address)
+            return self._reject(request, 403)
+
+        length = request.getHeader(b'content-length')
+        if length is not None and (not length.isdigit() or int(length) > self._max_body_size):
+            return self._reject(request, 413)
+
+        body = request.content.read(self._max_body_size + 1)
+        if len(body) > self._max_body_size:
+            return self._reject(request, 413)
+
+        body = body.strip()
+        if not (body.startswith(b'{') and body.endswith(b'}')): #обновление - всегда JSON-объект
+            return self._reject(request, 400)
+
+        try:
+            data = json.loads(body)
+            update = telebot.types.Update.de_json(data)
+            update.json = data #исходный JSON, как у telebot.types.Message - нужен, чтобы переложить обновление в очередь
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self._reject(request, 400)
+
+        reply = InlineReply(request) if self._inline else None
+        if not (self._submit(update, reply) if reply is not None else self._submit(update)):
+            #очередь этого пользователя переполнена - пусть Telegram повторит доставку позже
+            logger.warning('update queue is full, rejecting update %s', update.update_id)
+            request.setHeader(b'retry-after', b'1')
+            return self._reject(request, 429)
+
+        if reply is None:
+            return b''
+        #обработчик может ответить и раньше: _finish выполнится в реакторе уже после возврата из render_POST
+        reply.start(self._inline_timeout)
+        return NOT_DONE_YET